@@ -0,0 +1,327 @@
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from scipy.sparse import diags, load_npz, save_npz
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+
+from chunk_store import ChunkStore, write_chunk_store
+from incremental_index import N_FEATURES, IncrementalIndex
+from inverted_index import InvertedIndex, build_inverted_index
+from main import build_and_save_index
+from sharded_index import ShardedIndex, count_terms, write_shards
+from summarizer import Summarizer
+from tfidf_search import prepare_vectors, search_batch
+
+
+def fake_corpus(n_chunks, words_per_chunk=300, vocabulary=50000, seed=0):
+    """Zipf-distributed synthetic words, so a few terms are common and most are rare, like legal text."""
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, vocabulary + 1)
+    ids = rng.choice(vocabulary, size=(n_chunks, words_per_chunk), p=weights / weights.sum())
+    return [" ".join(f"w{i}" for i in row) for row in ids]
+
+
+def fake_questions(n_questions, vocabulary=50000, seed=1, first_term=20):
+    rng = random.Random(seed)
+    return [" ".join(f"w{rng.randrange(first_term, vocabulary // 10)}" for _ in range(6)) for _ in range(n_questions)]
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1] if len(timings) > 1 else timings[0]
+    print(f"{name:<28} mean {statistics.mean(timings) * 1000:8.2f} ms   p95 {p95 * 1000:8.2f} ms")
+
+
+def bench_search(args):
+    start = time.perf_counter()
+    chunks = fake_corpus(args.chunks)
+    vectorizer = TfidfVectorizer().fit(chunks)
+    vectors = vectorizer.transform(chunks)
+    print(f"{args.chunks} chunks, {vectors.shape[1]} terms, {vectors.nnz} non-zeros (built in {time.perf_counter() - start:.1f} s)")
+    questions = fake_questions(args.questions)
+
+    # Before: cosine_similarity re-normalizes the whole matrix, then a full argsort
+    before, expected = [], []
+    for question in questions:
+        start = time.perf_counter()
+        similarities = cosine_similarity(vectorizer.transform([question]), vectors).flatten()
+        top = similarities.argsort()[-args.top_k:][::-1]
+        before.append(time.perf_counter() - start)
+        expected.append([int(i) for i in top if similarities[i] > 0])
+
+    start = time.perf_counter()
+    term_vectors = prepare_vectors(vectors)
+    prepare_time = time.perf_counter() - start
+
+    # After: one sparse dot product over the query terms' postings, argpartition top-k
+    after, found = [], []
+    for question in questions:
+        start = time.perf_counter()
+        found.append([i for i, _ in search_batch([question], vectorizer, term_vectors, args.top_k)[0]])
+        after.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    search_batch(questions, vectorizer, term_vectors, args.top_k)
+    batch_time = time.perf_counter() - start
+
+    # Ties at the cut-off may be broken differently, so only the best hit is compared
+    agree = sum(a[:1] == b[:1] for a, b in zip(expected, found)) / len(questions)
+    report("cosine_similarity + argsort", before)
+    report("sparse dot + argpartition", after)
+    print(f"{'batch of ' + str(len(questions)):<28} {batch_time / len(questions) * 1000:8.2f} ms per question   (prepare {prepare_time * 1000:.0f} ms once)")
+    print(f"{'same top hit':<28} {agree:.2%}")
+
+
+def bench_inverted(args):
+    chunks = fake_corpus(args.chunks)
+    vectorizer = TfidfVectorizer().fit(chunks)
+    vectors = vectorizer.transform(chunks)
+    term_vectors = prepare_vectors(vectors)
+    postings_per_term = np.diff(term_vectors.indptr)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        build_inverted_index(vectors, tmp)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        index = InvertedIndex(tmp)
+        load_time = time.perf_counter() - start
+        save_npz(os.path.join(tmp, "vectors.npz"), vectors)
+        start = time.perf_counter()
+        prepare_vectors(load_npz(os.path.join(tmp, "vectors.npz")))
+        matrix_load_time = time.perf_counter() - start
+        print(f"{args.chunks} chunks, {vectors.nnz} postings (written in {build_time:.1f} s)")
+        print(f"startup: vectors.npz loaded and prepared in {matrix_load_time * 1000:.0f} ms, postings memory-mapped in {load_time * 1000:.1f} ms")
+
+        # Questions made only of rarer terms, and ones that also use the most frequent terms
+        for label, first_term in [("rare terms", 20), ("with common terms", 0)]:
+            questions = fake_questions(args.questions, first_term=first_term)
+            query_vectors = vectorizer.transform(questions)
+            total = sum(int(postings_per_term[query_vectors[i].indices].sum()) for i in range(len(questions)))
+
+            matrix, inverted, agree = [], [], 0
+            index.postings_read = 0
+            for row, question in enumerate(questions):
+                start = time.perf_counter()
+                expected = search_batch([question], vectorizer, term_vectors, args.top_k)[0]
+                matrix.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                found = index.search_batch(query_vectors[row], args.top_k)[0]
+                inverted.append(time.perf_counter() - start)
+                agree += [i for i, _ in expected] == [i for i, _ in found]
+
+            print(f"{label}: read {index.postings_read / total:.1%} of the query terms' postings, same top-{args.top_k} {agree / len(questions):.0%}")
+            report("  sparse matrix", matrix)
+            report("  inverted index", inverted)
+
+
+def bench_chunks(args):
+    rng = random.Random(0)
+    text = "".join(rng.choice("abcdefghij klmnop\n§₹") for _ in range(args.chunk_chars * 10))
+    chunks = [f"Chunk {i}: " + text[(i * 7919) % (len(text) - args.chunk_chars):][:args.chunk_chars] for i in range(args.chunks)]
+    # A chunk quoting the sentinel, which chunks.txt cannot represent
+    chunks[0] += "\n<|CHUNK|>\nquoted separator"
+    lookups = [[rng.randrange(args.chunks) for _ in range(args.top_k)] for _ in range(args.questions)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Before: chunks.txt with a sentinel line, read and split whole at startup
+        with open(os.path.join(tmp, "chunks.txt"), "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(chunk + "\n<|CHUNK|>\n")
+        start = time.perf_counter()
+        with open(os.path.join(tmp, "chunks.txt"), "r", encoding="utf-8") as f:
+            loaded = f.read().split("<|CHUNK|>\n")
+            loaded = [c.strip() for c in loaded if c.strip()]
+        text_load = time.perf_counter() - start
+
+        write_chunk_store(chunks, tmp)
+        start = time.perf_counter()
+        store = ChunkStore(tmp)
+        store_load = time.perf_counter() - start
+
+        text_lookups, store_lookups = [], []
+        for ids in lookups:
+            start = time.perf_counter()
+            [loaded[i] for i in ids]
+            text_lookups.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            [store[i] for i in ids]
+            store_lookups.append(time.perf_counter() - start)
+
+        assert all(store[i] == chunk for i, chunk in enumerate(chunks))
+        size = os.path.getsize(os.path.join(tmp, "chunks.bin")) / 2 ** 20
+
+    print(f"{args.chunks} chunks of {args.chunk_chars} characters ({size:.0f} MB)")
+    print(f"{'startup chunks.txt':<28} {text_load * 1000:8.1f} ms   ({len(loaded)} chunks read back)")
+    print(f"{'startup chunk store':<28} {store_load * 1000:8.1f} ms")
+    report(f"top-{args.top_k} from list", text_lookups)
+    report(f"top-{args.top_k} from chunk store", store_lookups)
+
+
+def bench_update(args):
+    chunks = fake_corpus(args.chunks + args.new_chunks)
+    old, new = chunks[:args.chunks], chunks[args.chunks:]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Stand-in source files; only their size, mtime and hash matter to the manifest
+        def source(name):
+            path = os.path.join(tmp, name)
+            with open(path, "w") as f:
+                f.write(name)
+            return path
+
+        start = time.perf_counter()
+        build_and_save_index(chunks, os.path.join(tmp, "full"))
+        full_time = time.perf_counter() - start
+
+        index = IncrementalIndex(os.path.join(tmp, "incremental"))
+        per_file = args.chunks // args.files
+        for i in range(args.files):
+            index.add(source(f"judgment{i}.pdf"), old[i * per_file:(i + 1) * per_file])
+        index.save()
+
+        start = time.perf_counter()
+        index = IncrementalIndex(os.path.join(tmp, "incremental"))
+        index.add(source("new_judgment.pdf"), new)
+        index.save()
+        add_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = IncrementalIndex(os.path.join(tmp, "incremental"))
+        index.remove("judgment0.pdf")
+        index.save()
+        remove_time = time.perf_counter() - start
+
+    print(f"{args.chunks} chunks in {args.files} files, adding one file of {args.new_chunks} chunks")
+    print(f"{'full refit':<28} {full_time:8.2f} s")
+    print(f"{'incremental add':<28} {add_time:8.2f} s")
+    print(f"{'incremental remove':<28} {remove_time:8.2f} s")
+
+
+def bench_shards(args):
+    chunks = fake_corpus(args.chunks)
+    shards = [chunks[start:start + args.shard_size] for start in range(0, len(chunks), args.shard_size)]
+    questions = fake_questions(args.questions)
+    print(f"{args.chunks} chunks in {len(shards)} shards, {os.cpu_count()} CPUs")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        timings = {}
+        for label, workers in [("serial", 1), ("process pool", args.workers)]:
+            path = os.path.join(tmp, label.replace(" ", "_"))
+            os.makedirs(path)
+            start = time.perf_counter()
+            shard_counts = count_terms(shards, N_FEATURES, max_workers=workers)
+            # Document frequencies are merged across shards before any shard is weighted
+            df = sum(np.bincount(counts.indices, minlength=N_FEATURES) for counts in shard_counts)
+            idf = np.log((1 + len(chunks)) / (1 + df)) + 1
+            write_shards(shard_counts, idf, path, max_workers=workers)
+            timings[label] = time.perf_counter() - start
+            print(f"{'build, ' + label:<28} {timings[label]:8.2f} s")
+
+        one_index = os.path.join(tmp, "single")
+        write_shards([count_terms([chunks], N_FEATURES, max_workers=1)[0]], idf, one_index, max_workers=1)
+        query_vectors = normalize(count_terms([questions], N_FEATURES, max_workers=1)[0] @ diags(idf), norm="l2")
+
+        single = ShardedIndex(one_index, max_workers=1)
+        expected = single.search_batch(query_vectors, args.top_k)
+        for label, index in [("single index", single), ("shards, serial", ShardedIndex(path, max_workers=1)), ("shards, process pool", ShardedIndex(path, max_workers=args.workers))]:
+            index.search_batch(query_vectors[:1], args.top_k)  # open the shards in every worker
+            per_question = []
+            for row in range(len(questions)):
+                start = time.perf_counter()
+                index.search_batch(query_vectors[row], args.top_k)
+                per_question.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            found = index.search_batch(query_vectors, args.top_k)
+            batch_time = time.perf_counter() - start
+            same = sum([i for i, _ in a] == [i for i, _ in b] for a, b in zip(expected, found)) / len(questions)
+            report(label, per_question)
+            print(f"{'':<28} batch of {len(questions)}: {batch_time / len(questions) * 1000:.2f} ms per question, same top-{args.top_k} {same:.0%}")
+            index.close()
+
+
+def bench_summarize(args):
+    # Three retrieved chunks per question, as search_chunks returns
+    chunks = fake_corpus(args.questions * 3, words_per_chunk=args.chunk_words, vocabulary=5000)
+    chunk_sets = [chunks[i:i + 3] for i in range(0, len(chunks), 3)]
+    summarizer = Summarizer(num_beams=args.beams, batch_size=args.batch_size, threads=args.threads)
+    tokenizer, _ = summarizer.load()
+    print(f"BART loaded in {summarizer.load_time:.2f} s, {args.beams} beams, {args.threads or 'default'} threads")
+    lengths = [len(tokenizer(" ".join(chunk_set))["input_ids"]) for chunk_set in chunk_sets]
+    print(f"{len(chunk_sets)} questions, {statistics.mean(lengths):.0f} tokens of context on average")
+
+    for label, batch_size in [("one at a time", 1), (f"batches of {args.batch_size}", args.batch_size)]:
+        summarizer.batch_size = batch_size
+        start = time.perf_counter()
+        if batch_size == 1:
+            for chunk_set in chunk_sets:
+                summarizer.summarize(chunk_set)
+        else:
+            summarizer.summarize_batch(chunk_sets)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<28} {elapsed:8.2f} s   {len(chunk_sets) / elapsed:6.2f} summaries/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the TF-IDF retriever")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    search = subparsers.add_parser("search", help="Query latency of search_chunks on a synthetic corpus")
+    search.add_argument("--chunks", type=int, default=100000)
+    search.add_argument("--questions", type=int, default=200)
+    search.add_argument("--top-k", type=int, default=3)
+    search.set_defaults(func=bench_search)
+
+    inverted = subparsers.add_parser("inverted", help="Impact-ordered inverted index with early termination vs the sparse matrix")
+    inverted.add_argument("--chunks", type=int, default=100000)
+    inverted.add_argument("--questions", type=int, default=200)
+    inverted.add_argument("--top-k", type=int, default=3)
+    inverted.set_defaults(func=bench_inverted)
+
+    chunk_store = subparsers.add_parser("chunks", help="Startup and lookup time of chunks.txt vs the memory-mapped chunk store")
+    chunk_store.add_argument("--chunks", type=int, default=100000)
+    chunk_store.add_argument("--chunk-chars", type=int, default=2000)
+    chunk_store.add_argument("--questions", type=int, default=200)
+    chunk_store.add_argument("--top-k", type=int, default=3)
+    chunk_store.set_defaults(func=bench_chunks)
+
+    update = subparsers.add_parser("update", help="Adding or removing one file incrementally vs refitting the whole index")
+    update.add_argument("--chunks", type=int, default=50000)
+    update.add_argument("--files", type=int, default=500)
+    update.add_argument("--new-chunks", type=int, default=20)
+    update.set_defaults(func=bench_update)
+
+    shards = subparsers.add_parser("shards", help="Sharded build and parallel per-shard search with top-k merge")
+    shards.add_argument("--chunks", type=int, default=100000)
+    shards.add_argument("--shard-size", type=int, default=20000)
+    shards.add_argument("--workers", type=int, default=None)
+    shards.add_argument("--questions", type=int, default=200)
+    shards.add_argument("--top-k", type=int, default=3)
+    shards.set_defaults(func=bench_shards)
+
+    summarize = subparsers.add_parser("summarize", help="BART summaries per second, one question at a time vs padded batches")
+    summarize.add_argument("--questions", type=int, default=16)
+    summarize.add_argument("--chunk-words", type=int, default=150)
+    summarize.add_argument("--beams", type=int, default=4)
+    summarize.add_argument("--batch-size", type=int, default=8)
+    summarize.add_argument("--threads", type=int, default=None)
+    summarize.set_defaults(func=bench_summarize)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+#python benchmark.py search --chunks 100000 --questions 200
+#python benchmark.py inverted --chunks 100000 --questions 200
+#python benchmark.py chunks --chunks 100000
+#python benchmark.py update --chunks 50000 --files 500
+#python benchmark.py shards --chunks 100000 --shard-size 20000
+#python benchmark.py summarize --questions 16 --batch-size 8 --threads 4
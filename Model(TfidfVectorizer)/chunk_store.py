@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+
+BLOB_FILE = "chunks.bin"
+OFFSETS_FILE = "chunk_offsets.npy"
+
+
+def write_chunk_store(chunks, path):
+    """
+    Writes chunks as one UTF-8 blob plus an offsets array (n + 1 int64), so chunk i is
+    blob[offsets[i]:offsets[i + 1]]. No separator is needed and chunk ids always
+    match the rows of the TF-IDF matrix.
+    """
+    os.makedirs(path, exist_ok=True)
+    offsets = [0]
+    with open(os.path.join(path, BLOB_FILE), "wb") as f:
+        for chunk in chunks:
+            data = chunk.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(path, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+
+
+def has_chunk_store(path):
+    return os.path.exists(os.path.join(path, OFFSETS_FILE))
+
+
+class ChunkStore:
+    """
+    Read-only, list-like view of a chunk store. Both files are memory-mapped, so
+    opening is instant whatever the corpus size and only the chunks that are
+    actually indexed get read from disk and decoded.
+    """
+    def __init__(self, path):
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        size = int(self.offsets[-1])
+        # np.memmap cannot map an empty file
+        self.blob = np.memmap(os.path.join(path, BLOB_FILE), dtype=np.uint8, mode="r") if size else np.empty(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError("chunk index out of range")
+        i %= len(self)
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
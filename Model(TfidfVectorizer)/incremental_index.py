@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import shutil
+from itertools import chain, groupby
+
+import joblib
+import numpy as np
+from scipy.sparse import csr_matrix, load_npz, save_npz, vstack
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import make_pipeline
+
+from chunk_store import ChunkStore, write_chunk_store
+from pdf_extraction import iter_pdf_pages, list_pdfs
+from sharded_index import SHARD_SIZE, count_terms, split_rows, write_shards
+
+N_FEATURES = 2 ** 20  # fixed hashed feature space, so adding text never changes the columns
+MANIFEST_FILE = "manifest.json"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_hashing_vectorizer(n_features=N_FEATURES):
+    # Same tokenization as TfidfVectorizer's defaults, raw counts out
+    return HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+
+
+class IncrementalIndex:
+    """
+    Updatable TF-IDF index over a folder of PDFs.
+
+    Next to the published files it keeps the raw term counts of every chunk, the
+    document frequency of every hashed feature and, in manifest.json, which file each
+    chunk came from with that file's size, mtime and sha256. Adding or removing a file
+    only tokenizes that file and adjusts the document frequencies; IDF is recomputed
+    from them when the index is saved, and the chunks are published as shards of
+    shard_size written in a process pool.
+    """
+    def __init__(self, path="index", n_features=N_FEATURES, shard_size=SHARD_SIZE, max_workers=None):
+        self.path = path
+        self.shard_size = shard_size
+        self.max_workers = max_workers
+        self.hashing = make_hashing_vectorizer(n_features)
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest["n_features"] != n_features:
+                raise ValueError(f"{path} was built with {manifest['n_features']} features, not {n_features}")
+            self.files = manifest["files"]
+            self.counts = load_npz(os.path.join(path, "counts.npz")).tocsr()
+            self.df = np.load(os.path.join(path, "df.npy"))
+            self.chunk_files = np.load(os.path.join(path, "chunk_files.npy"))
+            self.chunks = ChunkStore(path)
+        else:
+            # No manifest (new folder, or an index from build_and_save_index): start over
+            self.files = {}
+            self.counts = csr_matrix((0, n_features), dtype=np.float64)
+            self.df = np.zeros(n_features, dtype=np.int64)
+            self.chunk_files = np.empty(0, dtype=np.int32)
+            self.chunks = []
+        self._next_id = max((entry["id"] for entry in self.files.values()), default=-1) + 1
+        self._removed = set()
+        self._added = []  # (file id, chunks, counts)
+        self.touched = False
+
+    def changes(self, folder_path):
+        """Returns (paths of new or modified PDFs, names of indexed files that are gone)."""
+        changed = []
+        present = set()
+        for pdf_path in list_pdfs(folder_path):
+            name = os.path.basename(pdf_path)
+            present.add(name)
+            stat = os.stat(pdf_path)
+            entry = self.files.get(name)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+            # Touched but identical content only needs its mtime refreshed
+            if entry and entry["size"] == stat.st_size and entry["sha256"] == file_sha256(pdf_path):
+                entry["mtime"] = stat.st_mtime
+                self.touched = True
+                continue
+            changed.append(pdf_path)
+        return changed, [name for name in self.files if name not in present]
+
+    def remove(self, name):
+        entry = self.files.pop(name)
+        self._removed.add(entry["id"])
+
+    def add(self, pdf_path, chunks, counts=None):
+        """counts may be passed in when the chunks were already tokenized, e.g. by count_terms."""
+        name = os.path.basename(pdf_path)
+        if name in self.files:
+            self.remove(name)
+        stat = os.stat(pdf_path)
+        file_id = self._next_id
+        self._next_id += 1
+        self.files[name] = {"id": file_id, "size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_sha256(pdf_path)}
+        if counts is None:
+            counts = count_terms([chunks], len(self.df), max_workers=1)[0]
+        self.df += np.bincount(counts.indices, minlength=len(self.df))
+        self._added.append((file_id, chunks, counts))
+
+    @property
+    def dirty(self):
+        return bool(self._removed or self._added)
+
+    def write_manifest(self, path):
+        with open(os.path.join(path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump({"n_features": self.hashing.n_features, "files": self.files}, f, indent=1)
+
+    def save(self):
+        """Publishes vectorizer.pkl, the shards and the chunk store, and the update state."""
+        keep = ~np.isin(self.chunk_files, list(self._removed))
+        removed = self.counts[~keep]
+        self.df -= np.bincount(removed.indices, minlength=len(self.df))
+
+        counts = vstack([self.counts[keep]] + [c for _, _, c in self._added]).tocsr()
+        chunk_files = np.concatenate([self.chunk_files[keep]] + [np.full(len(chunks), file_id, dtype=np.int32) for file_id, chunks, _ in self._added])
+        kept_chunks = (self.chunks[i] for i in np.flatnonzero(keep))
+        new_chunks = (chunk for _, chunks, _ in self._added for chunk in chunks)
+
+        # Smoothed IDF as TfidfVectorizer computes it, from the stored document frequencies
+        idf = np.log((1 + counts.shape[0]) / (1 + self.df)) + 1
+        tfidf = TfidfTransformer()
+        tfidf.idf_ = idf
+        vectorizer = make_pipeline(self.hashing, tfidf)
+
+        # Written beside the live index and swapped in, so readers never see half an update.
+        # Uncompressed: zlib was most of the save time
+        tmp_path = self.path + ".tmp"
+        old_path = self.path + ".old"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        write_chunk_store(chain(kept_chunks, new_chunks), tmp_path)
+        joblib.dump(vectorizer, os.path.join(tmp_path, "vectorizer.pkl"))
+        write_shards(split_rows(counts, self.shard_size), idf, tmp_path, self.max_workers)
+        save_npz(os.path.join(tmp_path, "counts.npz"), counts, compressed=False)
+        np.save(os.path.join(tmp_path, "df.npy"), self.df)
+        np.save(os.path.join(tmp_path, "chunk_files.npy"), chunk_files)
+        self.write_manifest(tmp_path)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(self.path, old_path)
+        os.rename(tmp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+        self.counts, self.chunk_files, self.chunks = counts, chunk_files, ChunkStore(self.path)
+        self._removed, self._added, self.touched = set(), [], False
+        return vectorizer
+
+
+def update_index(folder_path, split, path="index", max_workers=None):
+    """
+    Brings the index at path in line with the PDFs in folder_path, tokenizing only
+    new and modified files. split turns one file's text into chunks.
+    Returns {"added": [...], "removed": [...], "chunks": n} or None if nothing changed.
+    """
+    index = IncrementalIndex(path, max_workers=max_workers)
+    changed, removed = index.changes(folder_path)
+    for name in removed:
+        index.remove(name)
+
+    pages = iter_pdf_pages(changed, max_workers=max_workers)
+    texts = {name: "".join(page.text for page in group) for name, group in groupby(pages, key=lambda page: page.source)}
+    # Files with no extractable text still enter the manifest, so they are not re-read
+    chunk_lists = [split(texts.get(os.path.basename(pdf_path), "")) for pdf_path in changed]
+    for pdf_path, chunks, counts in zip(changed, chunk_lists, count_terms(chunk_lists, len(index.df), max_workers)):
+        index.add(pdf_path, chunks, counts)
+
+    if not index.dirty:
+        if index.touched:
+            index.write_manifest(path)
+        return None
+    index.save()
+    return {"added": [os.path.basename(p) for p in changed], "removed": removed, "chunks": len(index.chunk_files)}
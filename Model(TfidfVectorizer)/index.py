@@ -1,61 +1,130 @@
 import os 
+import argparse
+import time
 import joblib
 from scipy.sparse import load_npz
-from sklearn.metrics.pairwise import cosine_similarity
+
+from chunk_store import ChunkStore, has_chunk_store
+from inverted_index import InvertedIndex
+from sharded_index import ShardedIndex, has_shards
+from summarizer import Summarizer
+from tfidf_search import prepare_vectors, search_batch
 
 def load_index(path="index"):
     vectorizer = joblib.load(os.path.join(path, "vectorizer.pkl"))
-    vectors = load_npz(os.path.join(path, "vectors.npz"))
+    if has_shards(path):
+        # Shards written by update_index, searched in parallel and merged
+        vectors = ShardedIndex(path)
+    elif os.path.isdir(os.path.join(path, "postings")):
+        # Memory-mapped impact-ordered postings; only the pages a query reads are loaded
+        vectors = InvertedIndex(os.path.join(path, "postings"))
+    else:
+        # Normalized and transposed once here, so queries only do a sparse dot product
+        vectors = prepare_vectors(load_npz(os.path.join(path, "vectors.npz")))
     
-    # Load the chunks
-    with open(os.path.join(path, "chunks.txt"), "r", encoding="utf-8") as f:
-        chunks = f.read().split("<|CHUNK|>\n")
-        chunks = [c.strip() for c in chunks if c.strip()]
+    # Load the chunks: memory-mapped, decoded only when a search returns them
+    if has_chunk_store(path):
+        chunks = ChunkStore(path)
+    else:
+        # Indexes built before the chunk store
+        with open(os.path.join(path, "chunks.txt"), "r", encoding="utf-8") as f:
+            chunks = f.read().split("<|CHUNK|>\n")
+            chunks = [c.strip() for c in chunks if c.strip()]
         
     return vectorizer, vectors, chunks
 
-vectorizer, vectors, chunks = load_index("index")
-
 def search_chunks(question, vectorizer, vectors, chunks, top_k=3):
-    query_vec = vectorizer.transform([question])
-    similarities = cosine_similarity(query_vec, vectors).flatten()
-    top_indices = similarities.argsort()[-top_k:][::-1]
-    return [chunks[i] for i in top_indices]
+    return search_chunks_batch([question], vectorizer, vectors, chunks, top_k)[0]
+
+def search_chunks_batch(questions, vectorizer, vectors, chunks, top_k=3):
+    if isinstance(vectors, (InvertedIndex, ShardedIndex)):
+        results = vectors.search_batch(vectorizer.transform(questions), top_k)
+    else:
+        # All questions are scored together in one sparse matmul per batch
+        results = search_batch(questions, vectorizer, vectors, top_k)
+    return [[chunks[i] for i, _ in hits] for hits in results]
 
 def generate_response(question, relevant_chunks):
     answer = "\n---\n".join(relevant_chunks)
     return f"Based on the documents, here’s what I found:\n\n{answer}"
 
 
+# One per process; BART is only loaded when the first summary is needed
+summarizer = Summarizer()
 
-question = input("Ask a question: ")
-relevant = search_chunks(question, vectorizer, vectors, chunks)
+def summarize_chunks_with_transformers(chunks):
+    return summarizer.summarize(chunks)
 
-from transformers import BartTokenizer, BartForConditionalGeneration
+def summarize_chunks_batch(chunk_sets):
+    return summarizer.summarize_batch(chunk_sets)
 
-# Initialize tokenizer and model
-tokenizer = BartTokenizer.from_pretrained("facebook/bart-large-cnn")
-model = BartForConditionalGeneration.from_pretrained("facebook/bart-large-cnn")
 
-def summarize_chunks_with_transformers(chunks):
-    # Combine all chunks into a single string
-    all_text = " ".join(chunks)
-    
-    # Tokenize the text
-    inputs = tokenizer(all_text, return_tensors="pt", truncation=True, max_length=1024)
-    
-    # Check if the input exceeds the model's token limit
-    if inputs["input_ids"].size(1) > 1024:
-        print("Text exceeds token limit, truncating...")
-        inputs["input_ids"] = inputs["input_ids"][:, :1024]  # Truncate the input to fit the token limit
-
-    # Generate summary
-    summary_ids = model.generate(inputs["input_ids"], num_beams=4, min_length=100, max_length=200, early_stopping=True)
-    summary = tokenizer.decode(summary_ids[0], skip_special_tokens=True)
-    
-    return summary
+def answer_questions(questions, vectorizer, vectors, chunks):
+    """Searches and summarizes a whole list of questions in batches; None where nothing matched."""
+    relevant = search_chunks_batch(questions, vectorizer, vectors, chunks)
+    found = [i for i, hits in enumerate(relevant) if hits]
+    summaries = summarize_chunks_batch([relevant[i] for i in found])
+    answers = [None] * len(questions)
+    for i, summary in zip(found, summaries):
+        answers[i] = summary
+    return answers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ask questions against the TF-IDF index")
+    parser.add_argument("--index", default="index")
+    parser.add_argument("--no-preload", action="store_true", help="Load BART on the first question instead of during startup")
+    parser.add_argument("--questions", help="Answer every line of this file in batches instead of asking interactively")
+    parser.add_argument("--beams", type=int, default=summarizer.num_beams)
+    parser.add_argument("--batch-size", type=int, default=summarizer.batch_size, help="Windows summarized per generate() call")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads (default: torch's own)")
+    args = parser.parse_args()
+    summarizer.num_beams, summarizer.batch_size, summarizer.threads = args.beams, args.batch_size, args.threads
+
+    started = time.perf_counter()
+    if not args.no_preload:
+        # BART loads in the background while the index loads
+        summarizer.preload()
+    vectorizer, vectors, chunks = load_index(args.index)
+    print(f"Index loaded in {time.perf_counter() - started:.2f} s")
+
+    if args.questions:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        asked = time.perf_counter()
+        answers = answer_questions(questions, vectorizer, vectors, chunks)
+        elapsed = time.perf_counter() - asked
+        for question, answer in zip(questions, answers):
+            print(f"Q: {question}\n{answer or 'No matching documents found.'}\n")
+        print(f"[{len(questions)} questions in {elapsed:.2f} s, {len(questions) / elapsed:.2f} answers/s]")
+        return
+
+    # Everything stays loaded between questions; an empty line or Ctrl-D quits
+    answered = False
+    while True:
+        try:
+            question = input("Ask a question: ").strip()
+        except EOFError:
+            break
+        if not question:
+            break
+
+        asked = time.perf_counter()
+        relevant = search_chunks(question, vectorizer, vectors, chunks)
+        searched = time.perf_counter()
+        if not relevant:
+            print("No matching documents found.")
+            continue
+        summary = summarize_chunks_with_transformers(relevant)
+        done = time.perf_counter()
+
+        print(summary)
+        timing = f"search {(searched - asked) * 1000:.1f} ms, summary {done - searched:.2f} s"
+        if not answered:
+            timing += f", first answer {done - started:.2f} s after startup (BART loaded in {summarizer.load_time:.2f} s)"
+            answered = True
+        print(f"[{timing}]")
 
-# Example usage
 
-summary = summarize_chunks_with_transformers(relevant)
-print(summary)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
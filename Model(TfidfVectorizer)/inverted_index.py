@@ -0,0 +1,127 @@
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
+
+from tfidf_search import top_k_indices
+
+FIRST_BLOCK = 64  # postings read per term in the first round; doubles every round
+MAX_RESCORE = 256  # keep reading postings until at most this many chunks need exact scores
+ARRAYS = ["term_offsets", "term_docs", "term_weights", "doc_offsets", "doc_terms", "doc_weights"]
+
+
+def build_inverted_index(vectors, path):
+    """
+    Writes the TF-IDF matrix (chunks x vocabulary columns) as compact numpy arrays:
+    per-term postings sorted by weight, highest impact first, plus the chunk rows
+    for exact re-scoring. Everything is saved as .npy so it can be memory-mapped.
+    """
+    os.makedirs(path, exist_ok=True)
+    doc_major = normalize(vectors.tocsr(), norm="l2").astype(np.float32)
+    doc_major.sort_indices()
+    term_major = doc_major.T.tocsr()
+    term_major.sort_indices()
+    # One index dtype for offsets and ids, so scipy can wrap the memory maps without copying
+    index_dtype = np.int32 if max(doc_major.nnz, *doc_major.shape) < 2 ** 31 else np.int64
+
+    # Impact order: sort each term's postings by descending weight, ties by chunk id.
+    # Positive float32 weights order like their bit patterns, so one stable int64
+    # argsort on (term, inverted weight bits) does it, much faster than np.lexsort
+    terms = np.repeat(np.arange(term_major.shape[0], dtype=np.int64), np.diff(term_major.indptr))
+    weight_bits = 0x7FFFFFFF - term_major.data.view(np.int32).astype(np.int64)
+    order = np.argsort((terms << 31) | weight_bits, kind="stable")
+
+    arrays = {
+        "term_offsets": term_major.indptr.astype(index_dtype),
+        "term_docs": term_major.indices[order].astype(index_dtype),
+        "term_weights": term_major.data[order].astype(np.float32),
+        "doc_offsets": doc_major.indptr.astype(index_dtype),
+        "doc_terms": doc_major.indices.astype(index_dtype),
+        "doc_weights": doc_major.data.astype(np.float32),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+
+
+class InvertedIndex:
+    """
+    Impact-ordered postings searched score-at-a-time with MaxScore-style early termination.
+
+    Each round reads the next block of every query term's postings, best weights
+    first, into per-chunk partial scores. The next unread weights (times the query
+    weights) bound what any chunk can still gain. Once the k-th best partial score
+    reaches that bound, no unseen chunk can enter the top k; as soon as few enough
+    seen chunks could still overtake it, reading stops and those are scored exactly
+    from their rows.
+    """
+    def __init__(self, path, mmap_mode="r"):
+        for name in ARRAYS:
+            # Plain ndarray views of the maps: slicing a np.memmap is much slower
+            setattr(self, name, np.asarray(np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)))
+        self.size = len(self.doc_offsets) - 1
+        self.vocabulary_size = len(self.term_offsets) - 1
+        self.rows = csr_matrix((self.doc_weights, self.doc_terms, self.doc_offsets), shape=(self.size, self.vocabulary_size), copy=False)
+        self.postings_read = 0
+        self.rescored = 0
+
+    def search(self, query_terms, query_weights, top_k=3):
+        """Returns up to top_k (chunk index, cosine similarity) pairs, best first."""
+        query_terms = np.asarray(query_terms, dtype=np.int64)
+        query_weights = np.asarray(query_weights, dtype=np.float32)
+        positions = self.term_offsets[query_terms].astype(np.int64)
+        ends = self.term_offsets[query_terms + 1].astype(np.int64)
+        accumulator = np.zeros(self.size, dtype=np.float32)
+        touched = np.zeros(self.size, dtype=bool)
+        candidates = np.empty(0, dtype=self.term_docs.dtype)
+        block = FIRST_BLOCK
+        bound = 0.0
+
+        while True:
+            for i in range(len(query_terms)):
+                stop = min(positions[i] + block, ends[i])
+                if stop > positions[i]:
+                    docs = self.term_docs[positions[i]:stop]
+                    accumulator[docs] += query_weights[i] * self.term_weights[positions[i]:stop]
+                    new = docs[~touched[docs]]
+                    touched[new] = True
+                    candidates = np.concatenate((candidates, new))
+                    self.postings_read += stop - positions[i]
+                    positions[i] = stop
+            block *= 2
+
+            remaining = positions < ends
+            if not remaining.any():
+                bound = 0.0
+                break
+            # Upper bound on what any chunk can still gain from unread postings
+            bound = float(np.dot(query_weights[remaining], self.term_weights[positions[remaining]]))
+            if len(candidates) < top_k:
+                continue
+            scores = accumulator[candidates]
+            kth = -np.partition(-scores, top_k - 1)[top_k - 1]
+            if kth >= bound:
+                # No unseen chunk can reach the top k; only these seen ones still can
+                survivors = candidates[scores + bound >= kth]
+                if len(survivors) <= max(MAX_RESCORE, top_k):
+                    candidates = survivors
+                    break
+
+        if bound > 0:
+            query = np.zeros(self.vocabulary_size, dtype=np.float32)
+            query[query_terms] = query_weights
+            scores = self.rows[candidates] @ query
+            self.rescored += len(candidates)
+        else:
+            scores = accumulator[candidates]
+        top = top_k_indices(scores, top_k)
+        return [(int(candidates[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+    def search_batch(self, query_vectors, top_k=3):
+        """Searches every row of a (questions x vocabulary) sparse matrix."""
+        query_vectors = normalize(query_vectors.tocsr(), norm="l2")
+        results = []
+        for row in range(query_vectors.shape[0]):
+            begin, end = query_vectors.indptr[row], query_vectors.indptr[row + 1]
+            results.append(self.search(query_vectors.indices[begin:end], query_vectors.data[begin:end], top_k))
+        return results
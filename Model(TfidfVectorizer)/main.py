@@ -1,17 +1,8 @@
 import os
-from PyPDF2 import PdfReader
-
-def extract_pdf_text(folder_path):
-    all_text = ""
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".pdf"):
-            reader = PdfReader(os.path.join(folder_path, filename))
-            for page in reader.pages:
-                text = page.extract_text()
-                if text:
-                    all_text += text
-    return all_text
 
+from chunk_store import write_chunk_store
+from incremental_index import update_index
+from inverted_index import build_inverted_index
 
 def split_text(text, chunk_size=2000, overlap=100):
     chunks = []
@@ -39,14 +30,17 @@ def build_and_save_index(chunks, path="index"):
     
     # Save the vector matrix
     save_npz(os.path.join(path, "vectors.npz"), vectors)
+
+    # Save the impact-ordered postings that index.py memory-maps for large corpora
+    build_inverted_index(vectors, os.path.join(path, "postings"))
     
-    # Save the chunks
-    with open(os.path.join(path, "chunks.txt"), "w", encoding="utf-8") as f:
-        for chunk in chunks:
-            f.write(chunk + "\n<|CHUNK|>\n")
+    # Save the chunks as a UTF-8 blob plus offsets, one entry per matrix row
+    write_chunk_store(chunks, path)
     return vectorizer, vectors
 
 
-text = extract_pdf_text("scr")
-chunks = split_text(text)
-vectorizer, vectors = build_and_save_index(chunks)
+# Guarded so process pool workers can import this module without rebuilding the index
+if __name__ == "__main__":
+    # Only new, modified and deleted PDFs in scr/ are processed; see manifest.json
+    changes = update_index("scr", split_text)
+    print(changes or "Index is up to date")
@@ -0,0 +1,132 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags, save_npz
+from sklearn.preprocessing import normalize
+
+from inverted_index import InvertedIndex, build_inverted_index
+
+SHARD_SIZE = 20000  # chunks per shard
+SHARDS_FILE = "shards.json"
+
+
+def _map(function, tasks, max_workers):
+    if len(tasks) <= 1 or (max_workers or os.cpu_count() or 1) == 1:
+        return [function(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(function, tasks))
+
+
+def _count_terms(task):
+    # Imported here: incremental_index itself imports this module
+    from incremental_index import make_hashing_vectorizer
+    chunks, n_features = task
+    if not chunks:
+        return csr_matrix((0, n_features), dtype=np.float64)
+    return make_hashing_vectorizer(n_features).transform(chunks)
+
+
+def count_terms(chunk_lists, n_features, max_workers=None):
+    """Raw hashed term counts for each list of chunks, tokenized in a process pool."""
+    return _map(_count_terms, [(chunks, n_features) for chunks in chunk_lists], max_workers)
+
+
+def _write_shard(task):
+    counts, idf, shard_path = task
+    vectors = normalize(counts @ diags(idf), norm="l2")
+    os.makedirs(shard_path, exist_ok=True)
+    save_npz(os.path.join(shard_path, "vectors.npz"), vectors, compressed=False)
+    build_inverted_index(vectors, os.path.join(shard_path, "postings"))
+    return counts.shape[0]
+
+
+def write_shards(shard_counts, idf, path, max_workers=None):
+    """
+    Applies the global IDF to each shard's counts and writes shard_NNN/ (vectors.npz
+    and postings) in a process pool, plus shards.json with each shard's first chunk id.
+    """
+    tasks = [(counts, idf, os.path.join(path, f"shard_{i:03d}")) for i, counts in enumerate(shard_counts)]
+    sizes = _map(_write_shard, tasks, max_workers)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(int).tolist()
+    with open(os.path.join(path, SHARDS_FILE), "w", encoding="utf-8") as f:
+        json.dump({"shards": [{"path": f"shard_{i:03d}", "start": start, "size": size} for i, (start, size) in enumerate(zip(starts, sizes))]}, f, indent=1)
+
+
+def split_rows(matrix, shard_size=SHARD_SIZE):
+    # An index with no chunks (every PDF removed, or none with text) has no shards
+    return [matrix[start:start + shard_size] for start in range(0, matrix.shape[0], shard_size)]
+
+
+def has_shards(path):
+    return os.path.exists(os.path.join(path, SHARDS_FILE))
+
+
+# Set in each query worker by _init_worker: the shard paths of the ShardedIndex that
+# owns the pool, and those shards, opened on first use and kept memory-mapped
+_worker_paths = []
+_worker_shards = {}
+
+
+def _init_worker(paths):
+    global _worker_paths, _worker_shards
+    _worker_paths = paths
+    _worker_shards = {}
+
+
+def _search_shard(task):
+    number, query_vectors, top_k = task
+    shard = _worker_shards.get(number)
+    if shard is None:
+        shard = _worker_shards[number] = InvertedIndex(_worker_paths[number])
+    return shard.search_batch(query_vectors, top_k)
+
+
+class ShardedIndex:
+    """
+    Searches every shard's inverted index and merges the per-shard top k into a
+    global top k. With several shards the searches run in a long-lived process pool,
+    so one question (or a batch of them) uses as many cores as there are shards.
+    Opened shards belong to this instance and its pool, so an index rebuilt on disk
+    is picked up by the next ShardedIndex.
+    """
+    def __init__(self, path, max_workers=None):
+        with open(os.path.join(path, SHARDS_FILE), "r", encoding="utf-8") as f:
+            shards = json.load(f)["shards"]
+        self.paths = [os.path.join(path, shard["path"], "postings") for shard in shards]
+        self.starts = [shard["start"] for shard in shards]
+        self.max_workers = max_workers
+        self._shards = {}
+        self._pool = None
+
+    def _shard(self, number):
+        shard = self._shards.get(number)
+        if shard is None:
+            shard = self._shards[number] = InvertedIndex(self.paths[number])
+        return shard
+
+    def _search_shards(self, query_vectors, top_k):
+        if not self.paths:
+            return []
+        workers = self.max_workers or min(len(self.paths), os.cpu_count() or 1)
+        if workers == 1:
+            return [self._shard(number).search_batch(query_vectors, top_k) for number in range(len(self.paths))]
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.paths,))
+        return list(self._pool.map(_search_shard, [(number, query_vectors, top_k) for number in range(len(self.paths))]))
+
+    def search_batch(self, query_vectors, top_k=3):
+        """Same results as one InvertedIndex over all chunks: (chunk index, score) pairs per question."""
+        per_shard = self._search_shards(query_vectors.tocsr(), top_k)
+        results = []
+        for row in range(query_vectors.shape[0]):
+            hits = [(start + i, score) for start, shard_hits in zip(self.starts, per_shard) for i, score in shard_hits[row]]
+            hits.sort(key=lambda hit: (-hit[1], hit[0]))
+            results.append(hits[:top_k])
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
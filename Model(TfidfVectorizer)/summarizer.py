@@ -0,0 +1,111 @@
+import threading
+import time
+
+SUMMARIZER_MODEL = "facebook/bart-large-cnn"
+WINDOW_TOKENS = 1024  # BART's input limit, special tokens included
+
+
+class Summarizer:
+    """
+    BART summarizer loaded once per process: on first use, or ahead of time in a
+    background thread with preload() so it loads while the index does.
+
+    Texts longer than one window are summarized map-reduce style: every window is
+    summarized, the partial summaries are joined and summarized again until they fit
+    one window, so nothing past the first 1024 tokens is dropped. Generation runs
+    in padded batches of up to batch_size windows, sorted by length, under
+    torch.inference_mode(); threads sets torch's intra-op thread count.
+    """
+    def __init__(self, model_name=SUMMARIZER_MODEL, num_beams=4, batch_size=8, threads=None, min_length=100, max_length=200):
+        self.model_name = model_name
+        self.num_beams = num_beams
+        self.batch_size = batch_size
+        self.threads = threads
+        self.min_length = min_length
+        self.max_length = max_length
+        self.load_time = None
+        self._tokenizer = None
+        self._model = None
+        self._lock = threading.Lock()
+        self._error = None
+
+    def preload(self):
+        thread = threading.Thread(target=self._preload, name="summarizer-load", daemon=True)
+        thread.start()
+        return thread
+
+    def _preload(self):
+        try:
+            self.load()
+        except Exception as e:  # raised again by the first summarize()
+            self._error = e
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                if self._error is not None:
+                    error, self._error = self._error, None
+                    raise error
+                start = time.perf_counter()
+                # transformers and torch take seconds to import, so only when needed
+                import torch
+                from transformers import BartTokenizer, BartForConditionalGeneration
+                if self.threads:
+                    torch.set_num_threads(self.threads)
+                self._tokenizer = BartTokenizer.from_pretrained(self.model_name)
+                self._model = BartForConditionalGeneration.from_pretrained(self.model_name)
+                self._model.eval()
+                self.load_time = time.perf_counter() - start
+            return self._tokenizer, self._model
+
+    def _generate(self, windows, min_length):
+        """Summaries of token id windows, generated in padded batches of similar length."""
+        import torch
+        tokenizer, model = self.load()
+        order = sorted(range(len(windows)), key=lambda i: len(windows[i]))
+        summaries = [None] * len(windows)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            inputs = tokenizer.pad({"input_ids": [windows[i] for i in batch]}, return_tensors="pt")
+            with torch.inference_mode():
+                summary_ids = model.generate(
+                    inputs["input_ids"],
+                    attention_mask=inputs["attention_mask"],
+                    num_beams=self.num_beams,
+                    min_length=min_length,
+                    max_length=self.max_length,
+                    early_stopping=True,
+                )
+            for i, text in zip(batch, tokenizer.batch_decode(summary_ids, skip_special_tokens=True)):
+                summaries[i] = text
+        return summaries
+
+    def summarize_batch(self, chunk_sets):
+        """One summary per list of chunks, e.g. the retrieved chunks of many questions at once."""
+        tokenizer, _ = self.load()
+        size = WINDOW_TOKENS - 2  # room for <s> and </s>
+
+        def tokens(text):
+            return tokenizer(text, add_special_tokens=False)["input_ids"]
+
+        def window(ids):
+            return [tokenizer.bos_token_id] + ids + [tokenizer.eos_token_id]
+
+        pending = {i: tokens(" ".join(chunks)) for i, chunks in enumerate(chunk_sets)}
+        results = [None] * len(chunk_sets)
+        while pending:
+            final = [i for i, ids in pending.items() if len(ids) <= size]
+            for i, summary in zip(final, self._generate([window(pending[i]) for i in final], self.min_length)):
+                results[i] = summary
+                del pending[i]
+
+            # Map: summarize every window of the longer texts; reduce on the next round
+            jobs = [(i, window(ids[start:start + size])) for i, ids in pending.items() for start in range(0, len(ids), size)]
+            partials = {i: [] for i in pending}
+            for (i, _), summary in zip(jobs, self._generate([ids for _, ids in jobs], 0)):
+                partials[i].append(summary)
+            pending = {i: tokens(" ".join(parts)) for i, parts in partials.items()}
+        return results
+
+    def summarize(self, chunks):
+        return self.summarize_batch([chunks])[0]
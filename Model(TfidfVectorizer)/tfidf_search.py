@@ -0,0 +1,44 @@
+import numpy as np
+from sklearn.preprocessing import normalize
+
+QUERY_BATCH_SIZE = 256  # questions scored per sparse matmul
+
+
+def prepare_vectors(vectors):
+    """
+    L2-normalizes the chunk matrix once and stores it term-major (terms x chunks, CSR),
+    so scoring a question only walks the postings of the terms it contains instead
+    of re-normalizing and touching every chunk like cosine_similarity does.
+    """
+    return normalize(vectors.tocsr(), norm="l2", copy=False).T.tocsr()
+
+
+def top_k_indices(scores, k):
+    """Indices of the k highest scores, best first, without sorting the whole array."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def score_queries(query_vectors, term_vectors):
+    """Cosine similarities of L2-normalized queries to every chunk, as a sparse (questions x chunks) matrix."""
+    return (query_vectors @ term_vectors).tocsr()
+
+
+def search_batch(questions, vectorizer, term_vectors, top_k=3, batch_size=QUERY_BATCH_SIZE):
+    """
+    Returns, for each question, up to top_k (chunk index, cosine similarity) pairs, best first.
+    Chunks sharing no term with a question are never candidates for it.
+    """
+    results = []
+    for start in range(0, len(questions), batch_size):
+        query_vectors = normalize(vectorizer.transform(questions[start:start + batch_size]), norm="l2", copy=False)
+        scores = score_queries(query_vectors, term_vectors)
+        for row in range(scores.shape[0]):
+            begin, end = scores.indptr[row], scores.indptr[row + 1]
+            data, indices = scores.data[begin:end], scores.indices[begin:end]
+            top = top_k_indices(data, top_k)
+            results.append([(int(indices[i]), float(data[i])) for i in top])
+    return results
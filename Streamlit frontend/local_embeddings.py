@@ -0,0 +1,67 @@
+import json
+import os
+import re
+import zlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+BACKEND_FILE = "backend.json"
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class EmbeddingBackendMismatch(RuntimeError):
+    """The index on disk was built with a different embedding backend than the one configured."""
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    In-process embeddings: unigrams and bigrams hashed (crc32, signed) into a fixed
+    number of dimensions, log-scaled and L2-normalized. No model, no network, and
+    stable across processes, so a question embeds in well under a millisecond.
+    """
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    @property
+    def backend_id(self):
+        return f"hashing:{self.dim}"
+
+    def _embed(self, text):
+        tokens = TOKEN_RE.findall(text.lower())
+        features = tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in features:
+            h = zlib.crc32(feature.encode("utf-8"))
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        np.copysign(np.log1p(np.abs(vector)), vector, out=vector)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def write_backend(index_path, backend_id):
+    with open(os.path.join(index_path, BACKEND_FILE), "w", encoding="utf-8") as f:
+        json.dump({"embedding_backend": backend_id}, f)
+
+
+def check_backend(index_path, backend_id, default="google:models/embedding-001"):
+    """Raises EmbeddingBackendMismatch unless the index was built with backend_id.
+    Indexes saved before backends were recorded count as built with default."""
+    path = os.path.join(index_path, BACKEND_FILE)
+    built_with = default
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            built_with = json.load(f)["embedding_backend"]
+    if built_with != backend_id:
+        raise EmbeddingBackendMismatch(
+            f"{index_path} was built with {built_with} embeddings but {backend_id} is configured; "
+            f"delete {index_path} to rebuild it or switch EMBEDDING_BACKEND back"
+        )
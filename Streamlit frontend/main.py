@@ -1,4 +1,6 @@
 import os
+import bisect
+import itertools
 import streamlit as st
 import requests
 from dotenv import load_dotenv
@@ -11,52 +13,91 @@ from langchain.prompts import PromptTemplate
 import google.generativeai as genai
 from docx import Document
 
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from pdf_extraction import iter_folder_pages
+from local_embeddings import EmbeddingBackendMismatch, HashingEmbeddings, check_backend, write_backend
+
 # Load API keys
 load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 TAVILY_API_URL = "https://api.tavily.com/search"
+EMBEDDING_MODEL = "models/embedding-001"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "google")  # "google" or the in-process "hashing"
+EMBED_BATCH_SIZE = 64  # chunks embedded per call while building the index
 
-# Tavily search
-def tavily_search(query):
+# Tavily search. Streamlit reruns the script on every interaction, so clients and
+# chains are cached resources: built once per server process and reused, connection included
+@st.cache_resource
+def get_tavily_client():
     from tavily import TavilyClient
-    tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
-    response = tavily_client.get_search_context(query)
+    return TavilyClient(api_key=TAVILY_API_KEY)
+
+def tavily_search(query):
+    response = get_tavily_client().get_search_context(query)
     return response
 
-# Read and combine text from all PDFs in a folder
-def get_all_pdf_texts(folder_path):
-    all_text = ""
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".pdf"):
-            pdf_path = os.path.join(folder_path, filename)
-            pdf_reader = PdfReader(pdf_path)
-            for page in pdf_reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    all_text += page_text
-    return all_text
+# Gemini clients, one per temperature
+@st.cache_resource
+def get_model(temperature):
+    return ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=temperature)
+
+# Split one document at a time, yielding (chunk, metadata) with the source file and start page
+def iter_document_chunks(pages):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=15000, chunk_overlap=1500, add_start_index=True)
+    for source, doc_pages in itertools.groupby(pages, key=lambda page: page.source):
+        doc_pages = list(doc_pages)
+        page_starts = [0] + list(itertools.accumulate(len(page.text) for page in doc_pages))[:-1]
+        text = "".join(page.text for page in doc_pages)
+        for doc in splitter.create_documents([text]):
+            start = max(doc.metadata["start_index"], 0)
+            page = doc_pages[bisect.bisect_right(page_starts, start) - 1].page
+            yield doc.page_content, {"source": source, "page": page}
+
+# Embeddings for the configured backend, and the id recorded with every index built from them
+def get_embeddings(cached=False):
+    if EMBEDDING_BACKEND == "hashing":
+        embeddings = HashingEmbeddings()
+        return embeddings, embeddings.backend_id
+    if cached:
+        embeddings = CachedEmbeddings(
+            GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL),
+            EmbeddingCache("embedding_cache", EMBEDDING_MODEL),
+        )
+    else:
+        embeddings = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+    return embeddings, f"google:{EMBEDDING_MODEL}"
 
-# Split text into chunks
-def get_text_chunks(text):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=15000, chunk_overlap=1500)
-    return splitter.split_text(text)
+def cache_stats(embeddings):
+    return embeddings.cache.stats() if isinstance(embeddings, CachedEmbeddings) else None
 
-# Save FAISS vector store
-def save_vector_store(text_chunks):
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-    vector_store = FAISS.from_texts(text_chunks, embedding=embeddings)
-    vector_store.save_local("faiss_index")
+# Embed (chunk, metadata) pairs in fixed-size batches, so memory does not grow with the corpus text
+def save_vector_store_from_chunks(chunks, batch_size=EMBED_BATCH_SIZE):
+    embeddings, backend_id = get_embeddings(cached=True)
+    chunks = iter(chunks)
+    vector_store = None
+    while True:
+        batch = list(itertools.islice(chunks, batch_size))
+        if not batch:
+            break
+        texts, metadatas = zip(*batch)
+        if vector_store is None:
+            vector_store = FAISS.from_texts(list(texts), embedding=embeddings, metadatas=list(metadatas))
+        else:
+            vector_store.add_texts(list(texts), metadatas=list(metadatas))
+    if vector_store is not None:
+        vector_store.save_local("faiss_index")
+        write_backend("faiss_index", backend_id)
+    return cache_stats(embeddings)
 
 # Load or create vector store from all PDFs
 def load_or_create_vector_store_from_folder(folder_path):
     if os.path.exists("faiss_index"):
         return
-    all_text = get_all_pdf_texts(folder_path)
-    chunks = get_text_chunks(all_text)
-    save_vector_store(chunks)
+    return save_vector_store_from_chunks(iter_document_chunks(iter_folder_pages(folder_path)))
 
 # Load conversational QA chain
+@st.cache_resource
 def get_conversational_chain():
     prompt_template = """
     You are a knowledgeable and reliable legal assistant specialized in Indian laws such as the IPC, RTI, labor laws, and other regulations. You are capable of understanding and responding to legal queries in multiple languages. If the user requests an answer in a specific language, you should provide your response in that language.
@@ -86,12 +127,16 @@ def get_conversational_chain():
     Answer (in the requested language, with citations if applicable):
     """
     prompt = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
-    model = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.3)
-    return load_qa_chain(model, chain_type="stuff", prompt=prompt)
+    return load_qa_chain(get_model(0.3), chain_type="stuff", prompt=prompt)
 
 # Handle user input
 def user_input_handler(user_question):
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+    embeddings, backend_id = get_embeddings()
+    try:
+        check_backend("faiss_index", backend_id)
+    except EmbeddingBackendMismatch as e:
+        st.error(str(e))
+        return
     vector_store = FAISS.load_local("faiss_index", embeddings, allow_dangerous_deserialization=True)
     docs = vector_store.similarity_search(user_question)
     chain = get_conversational_chain()
@@ -141,7 +186,7 @@ def user_input_handler(user_question):
 
             **Final Answer** (with legal references if possible):
             """
-            gemini_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.4)
+            gemini_model = get_model(0.4)
             gemini_response = gemini_model.invoke(prompt)
             status.update(label="Search complete", state="complete", expanded=False)
 
@@ -188,8 +233,7 @@ def analyze_legal_document(document_text):
     - Provide a summary of the document's key legal aspects in simple terms.
     """
     
-    model = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.3)
-    analysis_response = model.invoke(prompt)
+    analysis_response = get_model(0.3).invoke(prompt)
     return analysis_response.content
 
 # Custom CSS to inject into the Streamlit app
@@ -766,7 +810,9 @@ def streamlit_app():
                 with st.status("Initializing knowledge base..."):
                     st.write("Loading legal document database...")
                     if os.path.exists(st.session_state.pdf_folder):
-                        load_or_create_vector_store_from_folder(st.session_state.pdf_folder)
+                        cache_stats = load_or_create_vector_store_from_folder(st.session_state.pdf_folder)
+                        if cache_stats:
+                            st.write(f"Reused {cache_stats['hits']} cached chunk embeddings ({cache_stats['hit_rate']:.0%} hit rate)")
                         st.success("Knowledge base initialized successfully!")
                     else:
                         st.error(f"Error: The folder {st.session_state.pdf_folder} does not exist.")
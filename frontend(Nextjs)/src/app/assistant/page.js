@@ -28,6 +28,7 @@ export default function AIChatbotScreen() {
   const [input, setInput] = useState("");
   const [loading, setLoading] = useState(false);
   const [apiError, setApiError] = useState("");
+  const [sessionId, setSessionId] = useState("");
   const fileInputRef = useRef();
   const messagesEndRef = useRef(null);
   const scrollAreaRef = useRef(null);
@@ -145,7 +146,8 @@ export default function AIChatbotScreen() {
             selected_language: language,
             legal_area: legalArea,
             user_type: userType,
-            history_pq: JSON.stringify(messageHistory)
+            history_pq: JSON.stringify(messageHistory),
+            session_id: sessionId
         }));
         data = formData;
     } else {
@@ -155,27 +157,47 @@ export default function AIChatbotScreen() {
             selected_language: language,
             legal_area: legalArea,
             user_type: userType,
-            history_pq: JSON.stringify(messageHistory)
+            history_pq: JSON.stringify(messageHistory),
+            session_id: sessionId
         });
     }
 
-    const res = await fetch("http://localhost:8080/query", {
+    const res = await fetch("http://localhost:8080/query/stream", {
       method: "POST",
       headers: headers,
       body: data,
   });
 
 
-      console.log(res.body);
-
       if (res.ok) {
-        // Parse success response
-        try {
-          data = await res.json();
-          setMessages((prev) => [...prev, { role: "ai", data_source:data.source, content: data.ai_answer }]);
-        } catch (jsonError) {
-          console.error("JSON Parsing Error:", jsonError);
-          throw new Error("Invalid response format from server");
+        // Server-Sent Events: show the source first, then append answer text as it arrives
+        setMessages((prev) => [...prev, { role: "ai", data_source: "", content: "" }]);
+        setLoading(false);
+        const updateLast = (update) =>
+          setMessages((prev) => [...prev.slice(0, -1), update(prev[prev.length - 1])]);
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          const events = buffer.split("\n\n");
+          buffer = events.pop();
+          for (const raw of events) {
+            const event = raw.match(/^event: (.*)$/m)?.[1];
+            const payload = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] || "{}");
+            if (event === "source") {
+              updateLast((msg) => ({ ...msg, data_source: payload.source }));
+            } else if (event === "token") {
+              updateLast((msg) => ({ ...msg, content: msg.content + payload.text }));
+            } else if (event === "done") {
+              if (payload.session_id) setSessionId(payload.session_id);
+            } else if (event === "error") {
+              throw new Error(payload.error || "Request failed");
+            }
+          }
         }
       } else {
         // Handle error responses
@@ -0,0 +1,374 @@
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import weakref
+from http.server import HTTPServer
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+
+import main
+from context_packing import estimate_tokens
+from embedding_cache import EmbeddingCache
+from embedding_scheduler import EmbeddingScheduler
+from hybrid_retrieval import HybridRetriever, get_hybrid_retriever
+from local_embeddings import HashingEmbeddings
+from reranking import get_reranker, rerank
+
+# Offline embeddings with the same dimension as models/embedding-001,
+# so timings measure the index path and not the network
+EMBEDDING_SIZE = 768
+
+
+def fake_chunks(n_chunks, chunk_chars=2000):
+    words = ["section", "act", "court", "appeal", "fir", "rti", "ipc", "article", "petition", "bail"]
+    chunks = []
+    for i in range(n_chunks):
+        text = " ".join(words[(i + j) % len(words)] for j in range(chunk_chars // 6))
+        chunks.append(f"Chunk {i}: {text}")
+    return chunks
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1] if len(timings) > 1 else timings[0]
+    print(f"{name:<28} mean {statistics.mean(timings) * 1000:8.2f} ms   p95 {p95 * 1000:8.2f} ms")
+
+
+def bench_retrieval(args):
+    embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
+    questions = [f"What does section {i} of the IPC say?" for i in range(args.requests)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index_path = os.path.join(tmp, "faiss_index")
+        vector_store = FAISS.from_texts(fake_chunks(args.chunks), embedding=embeddings)
+        main.write_vector_store(vector_store, index_path)
+
+        # Before: load the index from disk on every request
+        per_request = []
+        for question in questions:
+            start = time.perf_counter()
+            store = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+            store.similarity_search(question)
+            per_request.append(time.perf_counter() - start)
+
+        # After: index loaded once at startup and shared
+        resident = main.ResidentVectorStore(index_path, embeddings=embeddings)
+        start = time.perf_counter()
+        resident.load()
+        load_time = time.perf_counter() - start
+        shared = []
+        for question in questions:
+            start = time.perf_counter()
+            resident.similarity_search(question)
+            shared.append(time.perf_counter() - start)
+
+    print(f"{args.chunks} chunks, {args.requests} requests (startup load {load_time * 1000:.2f} ms)")
+    report("load per request", per_request)
+    report("resident store", shared)
+
+
+def bench_serving(args):
+    # Stand in for the Gemini call with a fixed delay
+    def slow_handle_question(*_args, **_kwargs):
+        time.sleep(args.delay)
+        return {"source": "Dataset", "ai_answer": "ok"}
+    main.handle_question = slow_handle_question
+
+    payload = json.dumps({"question": "What is FIR?"}).encode()
+
+    def fire(port, statuses):
+        request = urllib.request.Request(f"http://127.0.0.1:{port}/query", data=payload, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                statuses.append(response.status)
+        except urllib.error.HTTPError as e:
+            statuses.append(e.code)
+        except (urllib.error.URLError, ConnectionError):
+            statuses.append(None)
+
+    def serve(server):
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        statuses = []
+        clients = [threading.Thread(target=fire, args=(server.server_address[1], statuses)) for _ in range(args.clients)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+        return elapsed, statuses
+
+    for name, server in [
+        ("HTTPServer", HTTPServer(("127.0.0.1", 0), main.LegalAssistantHandler)),
+        ("BoundedThreadPool", main.BoundedThreadPoolHTTPServer(("127.0.0.1", 0), main.LegalAssistantHandler, max_workers=args.workers, max_queue=args.queue)),
+    ]:
+        elapsed, statuses = serve(server)
+        ok = statuses.count(200)
+        print(f"{name:<20} {elapsed:6.2f} s   {ok / elapsed:7.2f} req/s   200: {ok}   503: {statuses.count(503)}   failed: {statuses.count(None)}")
+
+
+class FakeEmbeddingBackend(DeterministicFakeEmbedding):
+    """Local stand-in for the embedding API: fixed latency per call, random failures, optional hard stop."""
+    latency: float = 0.05
+    failure_rate: float = 0.0
+    fail_after: int = 0  # calls before every call fails, 0 for never
+    calls: int = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        time.sleep(self.latency)
+        if self.fail_after and self.calls > self.fail_after:
+            raise RuntimeError("backend down")
+        if random.random() < self.failure_rate:
+            raise RuntimeError("429 Resource exhausted")
+        return super().embed_documents(texts)
+
+
+def bench_build(args):
+    texts = fake_chunks(args.chunks, chunk_chars=200)
+
+    def run(name, scheduler):
+        start = time.perf_counter()
+        scheduler.embed_documents(texts)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<28} {elapsed:6.2f} s   calls {scheduler.embeddings.calls:4d}   retries {scheduler.retries}")
+
+    backend = FakeEmbeddingBackend(size=EMBEDDING_SIZE, latency=args.latency, failure_rate=args.failure_rate)
+    run("serial", EmbeddingScheduler(backend, batch_size=args.batch_size, concurrency=1, backoff=0.01))
+    backend = FakeEmbeddingBackend(size=EMBEDDING_SIZE, latency=args.latency, failure_rate=args.failure_rate)
+    run(f"scheduler x{args.concurrency}", EmbeddingScheduler(backend, batch_size=args.batch_size, concurrency=args.concurrency, requests_per_minute=args.rpm, backoff=0.01))
+
+    # Interrupted build: the backend dies halfway, the rerun only embeds what is left
+    with tempfile.TemporaryDirectory() as tmp:
+        n_batches = -(-args.chunks // args.batch_size)
+        backend = FakeEmbeddingBackend(size=EMBEDDING_SIZE, latency=args.latency, fail_after=n_batches // 2)
+        try:
+            EmbeddingScheduler(backend, cache=EmbeddingCache(tmp, "fake"), batch_size=args.batch_size, concurrency=1, max_retries=0).embed_documents(texts)
+        except RuntimeError:
+            pass
+        backend = FakeEmbeddingBackend(size=EMBEDDING_SIZE, latency=args.latency)
+        run("resumed build", EmbeddingScheduler(backend, cache=EmbeddingCache(tmp, "fake"), batch_size=args.batch_size, concurrency=args.concurrency))
+        print(f"{'':<28} {n_batches} batches in total")
+
+
+def legal_corpus(n_chunks, filler_words=300, seed=0, sentence_words=None):
+    """
+    Chunks that share most of their wording and differ in the section and Act they cite.
+    With sentence_words, the filler is cut into sentences of that many words.
+    """
+    acts = ["Indian Penal Code", "Code of Criminal Procedure", "Right to Information Act", "Indian Evidence Act", "Consumer Protection Act"]
+    common = ["court", "accused", "shall", "punishment", "offence", "person", "imprisonment", "fine", "term", "may",
+              "extend", "years", "provided", "whoever", "commits", "law", "order", "case", "appeal", "magistrate"]
+    rng = random.Random(seed)
+    chunks, questions = [], []
+    for i in range(n_chunks):
+        section, act = 100 + i, acts[i % len(acts)]
+        filler = [rng.choice(common) for _ in range(filler_words)]
+        if sentence_words:
+            filler = [word + "." if (j + 1) % sentence_words == 0 else word for j, word in enumerate(filler)]
+        filler = " ".join(filler)
+        chunks.append(f"Section {section} of the {act}. {filler}")
+        questions.append(f"What is the punishment under section {section} of the {act}?")
+    return chunks, questions
+
+
+def bench_recall(args):
+    embeddings = HashingEmbeddings(EMBEDDING_SIZE)
+    chunks, questions = legal_corpus(args.chunks)
+    vector_store = FAISS.from_texts(chunks, embedding=embeddings)
+    start = time.perf_counter()
+    retriever = HybridRetriever(vector_store)
+    print(f"{args.chunks} chunks, {args.queries} questions, k={args.k} (BM25 built in {(time.perf_counter() - start) * 1000:.0f} ms)")
+
+    expected = {chunk: i for i, chunk in enumerate(chunks)}
+    picked = random.Random(1).sample(range(len(questions)), min(args.queries, len(questions)))
+    vectors = {i: embeddings.embed_query(questions[i]) for i in picked}
+    runs = [
+        ("dense", lambda i: [retriever.documents[p] for p, _ in retriever.dense_search(vectors[i], args.k)]),
+        ("bm25", lambda i: [retriever.documents[p] for p, _ in retriever.bm25.search(questions[i], args.k)]),
+        ("hybrid", lambda i: [doc for doc, _ in retriever.search(questions[i], vectors[i], k=args.k)]),
+    ]
+    for name, search in runs:
+        hits, timings = 0, []
+        for i in picked:
+            start = time.perf_counter()
+            docs = search(i)
+            timings.append(time.perf_counter() - start)
+            hits += any(expected[doc.page_content] == i for doc in docs)
+        report(f"{name} recall@{args.k} {hits / len(picked):.2f}", timings)
+
+    # A cached retriever must not keep its store alive, or every overlay and swapped index leaks
+    stores = [FAISS.from_texts(chunks[:50], embedding=embeddings) for _ in range(5)]
+    refs = [weakref.ref(store) for store in stores]
+    for store in stores:
+        get_hybrid_retriever(store)
+    del stores, store
+    gc.collect()
+    print(f"retriever cache: {sum(ref() is not None for ref in refs)} of {len(refs)} dropped stores still alive")
+
+
+def bench_setup(args):
+    # Construction only: nothing here calls Gemini or Tavily
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from langchain.chains.question_answering import load_qa_chain
+    from tavily import TavilyClient
+
+    # Before: prompt, client and chain built for every request, plus a Tavily client on the web path
+    per_request = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        model = ChatGoogleGenerativeAI(model=main.GEMINI_MODEL, temperature=main.ANSWER_TEMPERATURE)
+        load_qa_chain(model, chain_type="stuff", prompt=main.get_qa_prompt())
+        ChatGoogleGenerativeAI(model=main.GEMINI_MODEL, temperature=main.WEB_TEMPERATURE)
+        TavilyClient(api_key="benchmark")
+        per_request.append(time.perf_counter() - start)
+
+    # After: built once at startup, looked up per request
+    registry = main.ChainRegistry()
+    start = time.perf_counter()
+    registry.warm()
+    warm_time = time.perf_counter() - start
+    shared = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        registry.chain(main.ANSWER_TEMPERATURE, "stuff")
+        registry.model(main.WEB_TEMPERATURE)
+        main.get_tavily_client()
+        shared.append(time.perf_counter() - start)
+
+    print(f"{args.requests} requests (startup warm {warm_time * 1000:.2f} ms)")
+    report("built per request", per_request)
+    report("chain registry", shared)
+
+
+def bench_packing(args):
+    # One long Act, split the way the index is, so retrieved neighbours share their 1500-char overlap
+    paragraphs, questions = legal_corpus(args.sections, sentence_words=20)
+    chunks = main.get_text_chunks("\n\n".join(paragraphs))
+    rng = random.Random(1)
+    requests = []
+    for _ in range(args.requests):
+        section = rng.randrange(args.sections)
+        # Counted as kept only if the start of the section's text survives, not just its heading
+        answer = paragraphs[section][:600]
+        hit = next(i for i, chunk in enumerate(chunks) if answer in chunk)
+        # The chunk with the answer plus its neighbours, as similarity_search tends to return
+        first = max(0, min(hit - 1, len(chunks) - args.k))
+        requests.append((section, answer, [(Document(page_content=chunk), 0.0) for chunk in chunks[first:first + args.k]]))
+
+    unpacked = [estimate_tokens(main.build_qa_prompt(questions[section], "user", "IPC", "English", [doc for doc, _ in results])) for section, _, results in requests]
+    print(f"{len(chunks)} chunks, {args.requests} questions, k={args.k}, budget {args.budget} tokens")
+    print(f"{'unpacked':<28} prompt tokens {statistics.mean(unpacked):8.0f}")
+    for label, spans in [("whole chunks", None), (f"best {args.spans} spans", args.spans)]:
+        prompt_tokens, timings, kept = [], [], 0
+        for section, answer, results in requests:
+            question = questions[section]
+            start = time.perf_counter()
+            context = main.pack_context(question, results, args.budget, spans)
+            timings.append(time.perf_counter() - start)
+            prompt_tokens.append(estimate_tokens(main.build_qa_prompt(question, "user", "IPC", "English", context.documents)))
+            kept += any(answer in doc.page_content for doc in context.documents)
+        print(f"{label:<28} prompt tokens {statistics.mean(prompt_tokens):8.0f}   answer section kept {kept / args.requests:.0%}")
+        report("", timings)
+
+
+def bench_rerank(args):
+    embeddings = HashingEmbeddings(EMBEDDING_SIZE)
+    chunks, questions = legal_corpus(args.chunks)
+    vector_store = FAISS.from_texts(chunks, embedding=embeddings)
+    expected = {chunk: i for i, chunk in enumerate(chunks)}
+    picked = random.Random(1).sample(range(len(questions)), min(args.queries, len(questions)))
+    vectors = {i: embeddings.embed_query(questions[i]) for i in picked}
+    print(f"{args.chunks} chunks, {len(picked)} questions, k={args.k}")
+
+    runs = [("dense, no reranking", None, args.k)]
+    for reranker in args.rerankers.split(","):
+        runs += [(f"{reranker} over {n}", reranker, n) for n in map(int, args.candidates.split(","))]
+    for name, reranker, n in runs:
+        hits, timings = 0, []
+        for i in picked:
+            start = time.perf_counter()
+            results = vector_store.similarity_search_with_score_by_vector(vectors[i], k=n)
+            if reranker:
+                results = rerank(get_reranker(reranker), questions[i], results, args.k)
+            timings.append(time.perf_counter() - start)
+            hits += any(expected[doc.page_content] == i for doc, _ in results[:args.k])
+        report(f"{name} recall@{args.k} {hits / len(picked):.2f}", timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the Legal AI microservice")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    retrieval = subparsers.add_parser("retrieval", help="Per-request retrieval latency")
+    retrieval.add_argument("--chunks", type=int, default=2000)
+    retrieval.add_argument("--requests", type=int, default=50)
+    retrieval.set_defaults(func=bench_retrieval)
+
+    serving = subparsers.add_parser("serving", help="Throughput with concurrent clients")
+    serving.add_argument("--clients", type=int, default=32)
+    serving.add_argument("--workers", type=int, default=8)
+    serving.add_argument("--queue", type=int, default=16)
+    serving.add_argument("--delay", type=float, default=0.2, help="Simulated model latency in seconds")
+    serving.set_defaults(func=bench_serving)
+
+    build = subparsers.add_parser("build", help="Embedding throughput, retries and resume against a fake backend")
+    build.add_argument("--chunks", type=int, default=2000)
+    build.add_argument("--batch-size", type=int, default=64)
+    build.add_argument("--concurrency", type=int, default=4)
+    build.add_argument("--rpm", type=int, default=None, help="Requests per minute limit")
+    build.add_argument("--latency", type=float, default=0.05, help="Simulated seconds per embedding call")
+    build.add_argument("--failure-rate", type=float, default=0.05)
+    build.set_defaults(func=bench_build)
+
+    recall = subparsers.add_parser("recall", help="Recall@k of dense, BM25 and hybrid retrieval on section-number questions")
+    recall.add_argument("--chunks", type=int, default=2000)
+    recall.add_argument("--queries", type=int, default=200)
+    recall.add_argument("--k", type=int, default=4)
+    recall.set_defaults(func=bench_recall)
+
+    setup = subparsers.add_parser("setup", help="Per-request cost of building prompts, Gemini clients and chains vs the registry")
+    setup.add_argument("--requests", type=int, default=200)
+    setup.set_defaults(func=bench_setup)
+
+    packing = subparsers.add_parser("packing", help="Prompt tokens before and after context packing")
+    packing.add_argument("--sections", type=int, default=2000)
+    packing.add_argument("--requests", type=int, default=200)
+    packing.add_argument("--k", type=int, default=4)
+    packing.add_argument("--budget", type=int, default=6000)
+    packing.add_argument("--spans", type=int, default=12)
+    packing.set_defaults(func=bench_packing)
+
+    rerank_parser = subparsers.add_parser("rerank", help="Recall@k and latency of dense search with and without re-ranking a larger candidate set")
+    rerank_parser.add_argument("--chunks", type=int, default=2000)
+    rerank_parser.add_argument("--queries", type=int, default=200)
+    rerank_parser.add_argument("--k", type=int, default=4)
+    rerank_parser.add_argument("--candidates", default="10,20,50")
+    rerank_parser.add_argument("--rerankers", default="lexical", help="Comma-separated; cross-encoder needs sentence-transformers")
+    rerank_parser.set_defaults(func=bench_rerank)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+#python benchmark.py retrieval --chunks 2000 --requests 50
+#python benchmark.py serving --clients 32 --workers 8 --queue 16
+#python benchmark.py build --chunks 2000 --concurrency 4 --failure-rate 0.05
+#python benchmark.py recall --chunks 2000 --queries 200 --k 4
+#python benchmark.py setup --requests 200
+#python benchmark.py packing --requests 200 --budget 6000 --spans 12
+#python benchmark.py rerank --chunks 2000 --candidates 10,20,50 --rerankers lexical,cross-encoder
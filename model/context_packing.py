@@ -0,0 +1,195 @@
+import math
+import re
+from collections import namedtuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from hybrid_retrieval import BM25Index, reciprocal_rank_fusion, tokenize, top_k_indices
+
+# Gemini's tokenizer is only reachable through the API, so token counts are estimated
+# locally; about 4 characters per token holds for English legal text
+CHARS_PER_TOKEN = 4
+MIN_OVERLAP = 200  # chars two chunks must share to count as overlapping; the splitter overlaps by up to 1500
+MIN_PASSAGE_TOKENS = 100  # a passage trimmed below this is left out instead
+BREAK_RE = re.compile(r"\n\s*\n|(?<=[.!?])\s+")  # paragraph or sentence ends
+PARAGRAPH_RE = re.compile(r"\n\s*\n")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+SPAN_CHARS = 1200  # sentences are grouped into spans of about this size
+
+PackedContext = namedtuple("PackedContext", ["documents", "stats"])
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def overlap(head, tail):
+    """Length of the longest suffix of head that is also a prefix of tail, 0 if under MIN_OVERLAP."""
+    probe = tail[:MIN_OVERLAP]
+    if len(probe) < MIN_OVERLAP:
+        return 0
+    position = head.find(probe)
+    while position != -1:
+        if tail.startswith(head[position:]):
+            return len(head) - position
+        position = head.find(probe, position + 1)
+    return 0
+
+
+def remove_overlaps(texts):
+    """
+    Drops text already present in an earlier entry: whole duplicates (the same chunk
+    from the base index and a session overlay) and the regions adjacent chunks of one
+    document share. Earlier entries keep their text, so pass them best first.
+    """
+    kept = []
+    for text in texts:
+        for other in kept:
+            if not text or not other:
+                continue
+            if text in other:
+                text = ""
+                break
+            n = overlap(other, text)
+            if n:
+                text = text[n:]
+            n = overlap(text, other)
+            if n:
+                text = text[:-n]
+        kept.append(text)
+    return kept
+
+
+def trim(text, max_chars):
+    """Cuts text to at most max_chars, at the last paragraph or sentence end if there is one."""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    ends = [match.start() for match in BREAK_RE.finditer(cut)]
+    return cut[:ends[-1]] if ends and ends[-1] > max_chars // 2 else cut
+
+
+def split_spans(text, max_chars=SPAN_CHARS):
+    """Paragraphs of text, with long ones (PDF text rarely has blank lines) cut into runs of sentences."""
+    spans = []
+    for paragraph in PARAGRAPH_RE.split(text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_chars:
+            if paragraph:
+                spans.append(paragraph)
+            continue
+        current = ""
+        for sentence in SENTENCE_RE.split(paragraph):
+            if current and len(current) + 1 + len(sentence) > max_chars:
+                spans.append(current)
+                current = sentence
+            else:
+                current = f"{current} {sentence}" if current else sentence
+        if current:
+            spans.append(current)
+    return spans
+
+
+def score_spans(question, spans, k1=1.5, b=0.75):
+    """
+    BM25 of every span against the question, with the spans as the collection.
+    Tokens are matched to question terms with one searchsorted over all spans, and
+    term frequencies counted with one bincount, instead of a dict per span.
+    """
+    terms = np.array(sorted(set(tokenize(question))))
+    span_tokens = [tokenize(span) for span in spans]
+    lengths = np.array([len(tokens) for tokens in span_tokens], dtype=np.float32)
+    if not len(terms) or not lengths.any():
+        return np.zeros(len(spans), dtype=np.float32)
+    tokens = np.array([token for span in span_tokens for token in span])
+    owners = np.repeat(np.arange(len(spans)), lengths.astype(np.int64))
+    term_ids = np.minimum(np.searchsorted(terms, tokens), len(terms) - 1)
+    match = terms[term_ids] == tokens
+    tf = np.bincount(owners[match] * len(terms) + term_ids[match], minlength=len(spans) * len(terms))
+    tf = tf.reshape(len(spans), len(terms)).astype(np.float32)
+
+    df = (tf > 0).sum(axis=0)
+    idf = np.log(1 + (len(spans) - df + 0.5) / (df + 0.5)).astype(np.float32)
+    norm = k1 * (1 - b + b * lengths / (lengths.mean() or 1.0))
+    return (idf * tf * (k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+
+
+def extract_passages(question, results, max_spans):
+    """
+    Cuts each retrieved chunk down to its spans that score best against the question,
+    at most max_spans over all chunks, kept in their original order. Chunks with no
+    selected span are dropped. If no span shares a term with the question (e.g. a
+    question in another language than the documents) the chunks are returned whole.
+    """
+    spans, owners = [], []
+    for position, (doc, _) in enumerate(results):
+        for span in split_spans(doc.page_content):
+            spans.append(span)
+            owners.append(position)
+    scores = score_spans(question, spans)
+    if not scores.any():
+        return results
+
+    chosen, seen = [], set()
+    for i in top_k_indices(scores, len(spans)):
+        if len(chosen) == max_spans or scores[i] <= 0:
+            break
+        # The overlap between neighbouring chunks yields the same span twice
+        if spans[i] not in seen:
+            seen.add(spans[i])
+            chosen.append(i)
+
+    selected = {}
+    for i in sorted(chosen):
+        selected.setdefault(owners[i], []).append(spans[i])
+    return [
+        (Document(page_content="\n\n".join(selected[position]), metadata=doc.metadata), score)
+        for position, (doc, score) in enumerate(results)
+        if position in selected
+    ]
+
+
+def pack_context(question, results, budget_tokens=None, max_spans=None):
+    """
+    Chooses what of the retrieved chunks goes into the prompt.
+
+    results are (document, score) pairs in retrieval order. With max_spans, each
+    chunk is first cut down to its best spans (see extract_passages). Passages are
+    ranked by retrieval order fused with BM25 over just these passages, text they
+    share with a better-ranked passage is removed, and they are added best first
+    until budget_tokens (None for no limit); the passage that crosses the budget is
+    trimmed at a sentence end. Returns PackedContext(documents, stats).
+    """
+    unpacked_tokens = sum(estimate_tokens(doc.page_content) for doc, _ in results)
+    retrieved = len(results)
+    if max_spans:
+        results = extract_passages(question, results, max_spans)
+    documents = [doc for doc, _ in results]
+    texts = [doc.page_content for doc in documents]
+    lexical = [position for position, _ in BM25Index(texts).search(question, len(texts))] if texts else []
+    order = [position for position, _ in reciprocal_rank_fusion([range(len(texts)), lexical], [1.0, 1.0])]
+    deduplicated = remove_overlaps([texts[position] for position in order])
+
+    packed, used = [], 0
+    for position, text in zip(order, deduplicated):
+        if not text.strip():
+            continue
+        tokens = estimate_tokens(text)
+        if budget_tokens is not None and used + tokens > budget_tokens:
+            room = budget_tokens - used
+            if room < MIN_PASSAGE_TOKENS:
+                continue  # a shorter passage further down may still fit
+            text = trim(text, room * CHARS_PER_TOKEN)
+            tokens = estimate_tokens(text)
+        packed.append(Document(page_content=text, metadata=documents[position].metadata))
+        used += tokens
+
+    stats = {
+        "passages": retrieved,
+        "passages_used": len(packed),
+        "duplicate_chars": sum(len(t) for t in texts) - sum(len(t) for t in deduplicated),
+        "context_tokens_unpacked": unpacked_tokens,
+        "context_tokens": used,
+    }
+    return PackedContext(packed, stats)
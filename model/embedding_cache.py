@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+DIGEST_SIZE = 32  # sha256
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of chunk embeddings keyed by (model name, sha256 of the chunk).
+
+    Each model gets its own folder with three files:
+        vectors.f32  raw float32 rows, appended and read back through np.memmap
+        keys.bin     the 32-byte chunk digests, one per row, in the same order
+        meta.json    model name and embedding dimension
+    Rows are written before their keys, so a crash mid-append only leaves
+    unreferenced rows behind, which are truncated on the next load.
+    """
+    def __init__(self, path="embedding_cache", model_name="models/embedding-001"):
+        self.model_name = model_name
+        self.folder = os.path.join(path, model_name.replace("/", "_"))
+        self.vectors_path = os.path.join(self.folder, "vectors.f32")
+        self.keys_path = os.path.join(self.folder, "keys.bin")
+        self.meta_path = os.path.join(self.folder, "meta.json")
+        self.dim = None
+        self.hits = 0
+        self.misses = 0
+        self._rows = {}  # digest -> row number
+        self._vectors = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            self.dim = json.load(f)["dim"]
+        with open(self.keys_path, "rb") as f:
+            keys = f.read()
+        n_rows = min(len(keys) // DIGEST_SIZE, os.path.getsize(self.vectors_path) // (4 * self.dim))
+        for row in range(n_rows):
+            self._rows[keys[row * DIGEST_SIZE:(row + 1) * DIGEST_SIZE]] = row
+        os.truncate(self.vectors_path, n_rows * 4 * self.dim)
+        os.truncate(self.keys_path, n_rows * DIGEST_SIZE)
+        self._map()
+
+    def _map(self):
+        n_rows = os.path.getsize(self.vectors_path) // (4 * self.dim)
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self.dim)) if n_rows else None
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def get_many(self, texts):
+        """Returns a list with the cached vector for each text, or None where it is missing."""
+        found = []
+        with self._lock:
+            for text in texts:
+                row = self._rows.get(self.digest(text))
+                found.append(None if row is None else self._vectors[row].tolist())
+            hits = sum(v is not None for v in found)
+            self.hits += hits
+            self.misses += len(texts) - hits
+        return found
+
+    def put_many(self, texts, vectors):
+        if not texts:
+            return
+        array = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = array.shape[1]
+                os.makedirs(self.folder, exist_ok=True)
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model_name, "dim": self.dim}, f)
+                open(self.vectors_path, "wb").close()
+                open(self.keys_path, "wb").close()
+
+            new_rows, new_keys = [], {}
+            next_row = len(self._rows)
+            for text, vector in zip(texts, array):
+                key = self.digest(text)
+                if key in self._rows or key in new_keys:
+                    continue
+                new_rows.append(vector)
+                new_keys[key] = None
+            if not new_keys:
+                return
+
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.stack(new_rows).tobytes())
+            with open(self.keys_path, "ab") as f:
+                f.write(b"".join(new_keys))
+            for offset, key in enumerate(new_keys):  # dicts keep insertion order
+                self._rows[key] = next_row + offset
+            self._map()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,90 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to capacity."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class EmbeddingScheduler(Embeddings):
+    """
+    Embeds documents in fixed-size batches on a small thread pool, throttled by a
+    token bucket and retried with exponential backoff on errors such as quota 429s.
+
+    With a cache (an EmbeddingCache), chunks already embedded are skipped and every
+    batch is written to it as soon as it completes, so a build that dies halfway
+    resumes from where it stopped when it is run again.
+    """
+    def __init__(self, embeddings, cache=None, batch_size=64, concurrency=4, requests_per_minute=None, max_retries=5, backoff=1.0):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(requests_per_minute / 60.0) if requests_per_minute else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.batches = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def _embed_batch(self, texts):
+        for attempt in range(self.max_retries + 1):
+            if self.bucket:
+                self.bucket.acquire()
+            try:
+                vectors = self.embeddings.embed_documents(texts)
+                break
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+        if self.cache is not None:
+            self.cache.put_many(texts, vectors)
+        with self._lock:
+            self.batches += 1
+        return vectors
+
+    def embed_documents(self, texts):
+        vectors = self.cache.get_many(texts) if self.cache is not None else [None] * len(texts)
+        missing = list(dict.fromkeys(texts[i] for i, v in enumerate(vectors) if v is None))
+        if not missing:
+            return vectors
+
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        if len(batches) == 1 or self.concurrency == 1:
+            results = [self._embed_batch(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embed") as pool:
+                results = list(pool.map(self._embed_batch, batches))
+
+        by_text = {}
+        for batch, batch_vectors in zip(batches, results):
+            by_text.update((text, list(vector)) for text, vector in zip(batch, batch_vectors))
+        return [v if v is not None else by_text[text] for text, v in zip(texts, vectors)]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
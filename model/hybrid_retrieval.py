@@ -0,0 +1,132 @@
+import math
+import re
+import threading
+import weakref
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Dense and sparse searches of one request run side by side on this pool
+search_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hybrid-search")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def top_k_indices(scores, k):
+    """Indices of the k highest scores, best first, without sorting the whole array."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of texts, with postings kept as numpy arrays per term."""
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(texts)
+        postings = defaultdict(lambda: ([], []))
+        self.lengths = np.zeros(self.size, dtype=np.float32)
+        for position, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            self.lengths[position] = sum(counts.values())
+            for term, tf in counts.items():
+                postings[term][0].append(position)
+                postings[term][1].append(tf)
+        self.avgdl = float(self.lengths.mean()) if self.size else 0.0
+        self.postings = {
+            term: (np.array(docs, dtype=np.int64), np.array(tfs, dtype=np.float32))
+            for term, (docs, tfs) in postings.items()
+        }
+        self.idf = {
+            term: math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, (docs, _) in self.postings.items()
+        }
+
+    def search(self, query, k):
+        """Returns (position, score) pairs for the k best matching texts."""
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            docs, tfs = self.postings[term]
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[docs] / (self.avgdl or 1.0))
+            scores[docs] += self.idf[term] * tfs * (self.k1 + 1) / (tfs + norm)
+        return [(int(i), float(scores[i])) for i in top_k_indices(scores, k) if scores[i] > 0]
+
+
+def reciprocal_rank_fusion(rankings, weights, rrf_k=60):
+    """Fuses ranked lists of keys: score = sum of weight / (rrf_k + rank)."""
+    fused = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, position in enumerate(ranking, start=1):
+            fused[position] += weight / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever:
+    """
+    Dense FAISS search and BM25 over the same chunks of one LangChain FAISS store,
+    run in parallel and merged with reciprocal rank fusion. Only the store's FAISS
+    index and documents are kept, not the store, so get_hybrid_retriever's cache
+    never keeps a store alive.
+    """
+    def __init__(self, vector_store):
+        self.index = vector_store.index
+        ids = vector_store.index_to_docstore_id
+        self.documents = [vector_store.docstore.search(ids[position]) for position in range(len(ids))]
+        self.bm25 = BM25Index([doc.page_content for doc in self.documents])
+
+    def dense_search(self, query_vector, k):
+        if not self.documents:
+            return []
+        vector = np.asarray([query_vector], dtype=np.float32)
+        distances, positions = self.index.search(vector, min(k, len(self.documents)))
+        return [(int(p), float(d)) for p, d in zip(positions[0], distances[0]) if p >= 0]
+
+    def search(self, question, query_vector, k=4, dense_weight=1.0, sparse_weight=1.0, candidates=20, rrf_k=60):
+        return hybrid_search([self], question, query_vector, k, dense_weight, sparse_weight, candidates, rrf_k)
+
+
+def hybrid_search(retrievers, question, query_vector, k=4, dense_weight=1.0, sparse_weight=1.0, candidates=20, rrf_k=60):
+    """
+    Runs dense and BM25 search over every retriever (e.g. the base corpus and a
+    session overlay) and fuses all the rankings with RRF. Returns up to k
+    (document, L2 distance) pairs in fused order; the distance is the dense one,
+    or inf for chunks that only BM25 found.
+    """
+    n = max(k, candidates)
+    dense_futures = [search_executor.submit(r.dense_search, query_vector, n) for r in retrievers]
+    rankings, weights, distances = [], [], {}
+    for i, retriever in enumerate(retrievers):
+        rankings.append([(i, p) for p, _ in retriever.bm25.search(question, n)])
+        weights.append(sparse_weight)
+    for i, future in enumerate(dense_futures):
+        dense = future.result()
+        rankings.append([(i, p) for p, _ in dense])
+        weights.append(dense_weight)
+        distances.update(((i, p), d) for p, d in dense)
+
+    fused = reciprocal_rank_fusion(rankings, weights, rrf_k)
+    return [(retrievers[i].documents[p], distances.get((i, p), math.inf)) for (i, p), _ in fused[:k]]
+
+
+_retrievers = weakref.WeakKeyDictionary()
+_retrievers_lock = threading.Lock()
+
+
+def get_hybrid_retriever(vector_store):
+    """One HybridRetriever per published store, built on first use and dropped with the store."""
+    with _retrievers_lock:
+        retriever = _retrievers.get(vector_store)
+        if retriever is None:
+            retriever = HybridRetriever(vector_store)
+            _retrievers[vector_store] = retriever
+        return retriever
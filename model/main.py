@@ -1,11 +1,23 @@
 import os
 import json
+import bisect
+import itertools
+import math
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import parse_qs
 from io import BytesIO
 import re
+import shutil
+import socket
+import string
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from PyPDF2 import PdfReader
+from PyPDF2.errors import PdfReadError
 from docx import Document
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -14,50 +26,504 @@ from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmb
 from langchain.chains.question_answering import load_qa_chain
 from langchain.prompts import PromptTemplate
 import google.generativeai as genai
+import numpy as np
+
+from context_packing import estimate_tokens, pack_context
+from embedding_cache import EmbeddingCache
+from embedding_scheduler import EmbeddingScheduler
+from hybrid_retrieval import get_hybrid_retriever, hybrid_search
+from local_embeddings import HashingEmbeddings, check_backend, write_backend
+from reranking import RERANKERS, get_reranker, rerank as rerank_results
+from multipart import MultipartError, parse_multipart
+from pdf_extraction import iter_folder_pages
 
 # Load API keys
 load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 
+EMBEDDING_MODEL = "models/embedding-001"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "google")  # "google" or the in-process "hashing"
+HASHING_DIM = int(os.getenv("HASHING_DIM", "768"))
+
+# Serving limits
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))  # requests handled at once
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "16"))  # accepted requests waiting for a worker
+RETRY_AFTER = int(os.getenv("RETRY_AFTER", "5"))  # seconds, sent with 503 when saturated
+REJECT_WORKERS = 2  # threads that send the 503s, so a slow client never holds up accepting
+MAX_REJECTS = 64  # 503s waiting to be sent; connections beyond that are closed straight away
+REJECT_LINGER = 2.0  # seconds a rejected request's body is drained, so the client reads the 503 instead of a reset
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))  # chunks embedded per call while building
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))  # embedding calls in flight
+EMBED_REQUESTS_PER_MINUTE = int(os.getenv("EMBED_REQUESTS_PER_MINUTE", "0")) or None  # unset means no throttle
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(50 * 1024 * 1024)))  # bytes
+
+# Per-session upload indexes
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "100"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))  # seconds since last use
+
+# Retrieval
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")  # "dense" (FAISS only) or "hybrid" (FAISS + BM25, fused)
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "4"))
+MAX_RETRIEVAL_K = 20
+DENSE_WEIGHT = float(os.getenv("DENSE_WEIGHT", "1.0"))
+SPARSE_WEIGHT = float(os.getenv("SPARSE_WEIGHT", "1.0"))
+RERANKER = os.getenv("RERANKER", "none")  # "none", "lexical" (BM25) or "cross-encoder" (needs sentence-transformers)
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))  # fetched for the reranker to choose k from
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))  # retrieved text per dataset prompt; 0 means no limit
+PASSAGE_SPANS = int(os.getenv("PASSAGE_SPANS", "12"))  # best paragraphs/sentence runs kept from the retrieved chunks; 0 keeps chunks whole
+
+# Answer cache
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "86400"))  # seconds
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # cosine similarity
+
+# Gemini
+GEMINI_MODEL = "gemini-2.0-flash"
+ANSWER_TEMPERATURE = 0.3  # dataset answers and document analysis
+WEB_TEMPERATURE = 0.4  # answers from Tavily results
+
+# Web fallback
+SPECULATIVE_WEB_SEARCH = os.getenv("SPECULATIVE_WEB_SEARCH", "false").lower() == "true"  # run Tavily alongside the dataset answer
+MAX_RETRIEVAL_DISTANCE = float(os.getenv("MAX_RETRIEVAL_DISTANCE")) if os.getenv("MAX_RETRIEVAL_DISTANCE") else None  # L2; farther goes straight to the web
+# Per reranker, since BM25 scores (>= 0, unbounded) and cross-encoder logits are on different scales; lower goes to the web
+MIN_RERANK_SCORES = {
+    "lexical": float(os.getenv("MIN_LEXICAL_SCORE")) if os.getenv("MIN_LEXICAL_SCORE") else None,
+    "cross-encoder": float(os.getenv("MIN_CROSS_ENCODER_SCORE")) if os.getenv("MIN_CROSS_ENCODER_SCORE") else None,
+}
+
 # Tavily search
+_tavily_client = None
+_tavily_lock = threading.Lock()
+
+def get_tavily_client():
+    # One client per process, so its requests session keeps the connection to Tavily open
+    global _tavily_client
+    with _tavily_lock:
+        if _tavily_client is None:
+            from tavily import TavilyClient
+            _tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
+        return _tavily_client
+
 def tavily_search(query):
-    from tavily import TavilyClient
-    tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
-    response = tavily_client.get_search_context(query)
+    response = get_tavily_client().get_search_context(query)
     return response
 
 # File processing
-def get_all_pdf_texts(folder_path):
-    all_text = ""
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".pdf"):
-            pdf_path = os.path.join(folder_path, filename)
-            pdf_reader = PdfReader(pdf_path)
-            for page in pdf_reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    all_text += page_text
-    return all_text
+def get_pdf_text(pdf):
+    pdf_reader = PdfReader(pdf)
+    page_texts = [page.extract_text() for page in pdf_reader.pages]
+    return "".join(t for t in page_texts if t)
 
 def get_text_chunks(text):
     splitter = RecursiveCharacterTextSplitter(chunk_size=15000, chunk_overlap=1500)
     return splitter.split_text(text)
 
-def save_vector_store(text_chunks):
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-    vector_store = FAISS.from_texts(text_chunks, embedding=embeddings)
-    vector_store.save_local("faiss_index")
+def iter_document_chunks(pages):
+    """
+    Splits a page stream one document at a time, so chunks never straddle two PDFs
+    and only the current document is held in memory. Yields (chunk, metadata) with
+    the source file and the page each chunk starts on.
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=15000, chunk_overlap=1500, add_start_index=True)
+    for source, doc_pages in itertools.groupby(pages, key=lambda page: page.source):
+        doc_pages = list(doc_pages)
+        page_starts = [0] + list(itertools.accumulate(len(page.text) for page in doc_pages))[:-1]
+        text = "".join(page.text for page in doc_pages)
+        for doc in splitter.create_documents([text]):
+            start = max(doc.metadata["start_index"], 0)
+            page = doc_pages[bisect.bisect_right(page_starts, start) - 1].page
+            yield doc.page_content, {"source": source, "page": page}
+
+def write_vector_store(vector_store, index_path="faiss_index", backend_id=None):
+    # Write next to the live index and rename into place, so a crash mid-save
+    # never leaves a half-written faiss_index behind. backend_id, when given, is
+    # recorded with the index so it is never loaded with a different embedder
+    tmp_path = index_path + ".tmp"
+    old_path = index_path + ".old"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    vector_store.save_local(tmp_path)
+    if backend_id:
+        write_backend(tmp_path, backend_id)
+    if os.path.exists(index_path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(index_path, old_path)
+    os.rename(tmp_path, index_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+def add_to_vector_store(text_chunks, source=None, session_id=None):
+    """
+    Appends chunks to the resident index without re-embedding what is already there.
+    The live index is copied, extended and swapped in, so searches in flight never
+    see a half-updated index, and the data/ corpus built at boot is kept.
+    With a session_id the chunks go to that session's overlay index instead.
+    """
+    if not text_chunks:
+        return resident_store.get()
+    embeddings = resident_store.embeddings
+    vectors = embeddings.embed_documents(text_chunks)
+    metadatas = [{"source": source} for _ in text_chunks] if source else None
+
+    if session_id:
+        return session_indexes.add(session_id, text_chunks, vectors, metadatas)
+
+    with index_lock:
+        base = resident_store.get()
+        updated = FAISS.deserialize_from_bytes(base.serialize_to_bytes(), embeddings, allow_dangerous_deserialization=True)
+        updated.add_embeddings(list(zip(text_chunks, vectors)), metadatas=metadatas)
+        write_vector_store(updated, resident_store.index_path, resident_store.backend_id)
+        resident_store.swap(updated)
+    return updated
+
+def build_vector_store(chunks, embeddings, index_path="faiss_index", batch_size=EMBED_BATCH_SIZE * EMBED_CONCURRENCY, backend_id=None):
+    """
+    Embeds (chunk, metadata) pairs from any iterable a window at a time and saves the index.
+    Each window is spread over the embedding scheduler's concurrent batches.
+    """
+    chunks = iter(chunks)
+    vector_store = None
+    while True:
+        window = list(itertools.islice(chunks, batch_size))
+        if not window:
+            break
+        texts, metadatas = zip(*window)
+        text_embeddings = list(zip(texts, embeddings.embed_documents(list(texts))))
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=list(metadatas))
+        else:
+            vector_store.add_embeddings(text_embeddings, metadatas=list(metadatas))
+    if vector_store is not None:
+        write_vector_store(vector_store, index_path, backend_id)
+    return vector_store
 
 def load_or_create_vector_store_from_folder(folder_path):
     if not os.path.exists("faiss_index"):
-        all_text = get_all_pdf_texts(folder_path)
-        chunks = get_text_chunks(all_text)
-        save_vector_store(chunks)
+        chunks = iter_document_chunks(iter_folder_pages(folder_path))
+        # Only the corpus build uses the on-disk cache; uploads and questions are never written to it
+        embeddings, backend_id = create_embeddings(cache=True)
+        build_vector_store(chunks, embeddings, backend_id=backend_id)
+        if isinstance(embeddings, EmbeddingScheduler) and embeddings.cache is not None:
+            print("Embedding cache:", embeddings.cache.stats(), "batches:", embeddings.batches, "retries:", embeddings.retries)
+
+# Embedding backends
+def create_embeddings(backend=EMBEDDING_BACKEND, cache=False):
+    """
+    Returns (embeddings, backend_id); the id is stored with every index built.
+    cache=True adds the on-disk embedding cache, meant for corpus builds only:
+    it is never evicted, so private uploads must not go through it.
+    """
+    if backend == "hashing":
+        embeddings = HashingEmbeddings(HASHING_DIM)
+        return embeddings, embeddings.backend_id
+    if backend == "google":
+        # With the cache, chunks seen in an earlier build are served from disk,
+        # which also checkpoints an interrupted build
+        embeddings = EmbeddingScheduler(
+            GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL),
+            cache=EmbeddingCache("embedding_cache", EMBEDDING_MODEL) if cache else None,
+            batch_size=EMBED_BATCH_SIZE,
+            concurrency=EMBED_CONCURRENCY,
+            requests_per_minute=EMBED_REQUESTS_PER_MINUTE,
+            max_retries=EMBED_MAX_RETRIES,
+        )
+        return embeddings, f"google:{EMBEDDING_MODEL}"
+    raise ValueError(f"Unknown EMBEDDING_BACKEND {backend!r}")
+
+# Resident vector store
+class ResidentVectorStore:
+    """
+    Keeps the embeddings client and the loaded FAISS index in memory for the
+    lifetime of the process, so /query does not unpickle the index per request.
+    """
+    def __init__(self, index_path="faiss_index", embeddings=None, backend_id=None):
+        self.index_path = index_path
+        self._embeddings = embeddings
+        self._backend_id = backend_id  # None skips the backend check for injected embeddings
+        self._vector_store = None
+        self._lock = threading.Lock()
+        self.version = 0  # bumped on every swap, so caches can tell the index changed
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            self._embeddings, self._backend_id = create_embeddings()
+        return self._embeddings
+
+    @property
+    def backend_id(self):
+        self.embeddings
+        return self._backend_id
+
+    def _load_from_disk(self):
+        if self.backend_id:
+            check_backend(self.index_path, self.backend_id)
+        return FAISS.load_local(self.index_path, self.embeddings, allow_dangerous_deserialization=True)
+
+    def load(self):
+        vector_store = self._load_from_disk()
+        self.swap(vector_store)
+        return vector_store
+
+    def swap(self, vector_store):
+        # Handlers grab the reference once per request, so replacing it is atomic for them
+        with self._lock:
+            self._vector_store = vector_store
+            self.version += 1
+
+    def get(self):
+        vector_store = self._vector_store
+        if vector_store is None:
+            with self._lock:
+                if self._vector_store is None:
+                    self._vector_store = self._load_from_disk()
+                vector_store = self._vector_store
+        return vector_store
+
+    def similarity_search(self, query, k=4):
+        return self.get().similarity_search(query, k=k)
+
+resident_store = ResidentVectorStore("faiss_index")
+index_lock = threading.Lock()  # serializes writers; readers only swap references
+
+# Session overlay indexes
+class SessionIndexes:
+    """
+    Small in-memory FAISS indexes holding each session's uploaded documents,
+    searched on top of the base corpus. Least recently used sessions are dropped
+    beyond max_sessions, and any session idle for longer than ttl seconds.
+    """
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # session_id -> (vector_store, last_used)
+        self._lock = threading.Lock()
+
+    def add(self, session_id, text_chunks, vectors, metadatas=None):
+        with self._lock:
+            self._evict()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                vector_store = FAISS.from_embeddings(list(zip(text_chunks, vectors)), resident_store.embeddings, metadatas=metadatas)
+            else:
+                # Copy on write, like the base index, so searches in flight are unaffected
+                vector_store = FAISS.deserialize_from_bytes(entry[0].serialize_to_bytes(), resident_store.embeddings, allow_dangerous_deserialization=True)
+                vector_store.add_embeddings(list(zip(text_chunks, vectors)), metadatas=metadatas)
+            self._sessions[session_id] = (vector_store, time.monotonic())
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return vector_store
+
+    def get(self, session_id):
+        with self._lock:
+            self._evict()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (entry[0], time.monotonic())
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._sessions:
+            session_id, (_, last_used) = next(iter(self._sessions.items()))
+            if last_used >= cutoff:
+                break
+            del self._sessions[session_id]
+
+session_indexes = SessionIndexes()
+
+def retrieve_documents_with_scores(user_question, session_id=None, k=RETRIEVAL_K, query_vector=None, mode=RETRIEVAL_MODE, dense_weight=DENSE_WEIGHT, sparse_weight=SPARSE_WEIGHT, rerank=RERANKER):
+    """
+    Searches the base corpus and, if present, the session's uploads.
+    Returns (document, L2 distance) pairs: closest first in dense mode, in fused
+    rank order in hybrid mode, where chunks only BM25 found have distance inf.
+    With a reranker, RERANK_CANDIDATES are fetched that way and the k it scores
+    best are returned in its order, each with metadata["rerank_score"].
+    """
+    if rerank != "none":
+        candidates = retrieve_documents_with_scores(user_question, session_id, max(k, RERANK_CANDIDATES), query_vector, mode, dense_weight, sparse_weight, rerank="none")
+        return rerank_results(get_reranker(rerank), user_question, candidates, k)
+
+    if query_vector is None:
+        query_vector = resident_store.embeddings.embed_query(user_question)
+    stores = [resident_store.get()]
+    overlay = session_indexes.get(session_id) if session_id else None
+    if overlay is not None:
+        stores.append(overlay)
+
+    if mode == "hybrid":
+        # Exact section numbers and statute names that embeddings blur are caught by BM25
+        retrievers = [get_hybrid_retriever(store) for store in stores]
+        return hybrid_search(retrievers, user_question, query_vector, k, dense_weight, sparse_weight)
+
+    results = []
+    for store in stores:
+        results += store.similarity_search_with_score_by_vector(query_vector, k=k)
+    results.sort(key=lambda pair: pair[1])
+    return results[:k]
+
+def parse_retrieval_options(options):
+    """
+    Validates the optional per-request "retrieval" object, e.g.
+    {"mode": "hybrid", "k": 6, "dense_weight": 1.0, "sparse_weight": 0.5, "rerank": "lexical"}.
+    Returns keyword arguments for retrieve_documents_with_scores; raises ValueError.
+    """
+    if not options:
+        return {}
+    if isinstance(options, str):
+        options = json.loads(options)
+    if not isinstance(options, dict):
+        raise ValueError("retrieval must be an object")
+    unknown = set(options) - {"mode", "k", "dense_weight", "sparse_weight", "rerank"}
+    if unknown:
+        raise ValueError(f"Unknown retrieval options: {', '.join(sorted(unknown))}")
+    retrieval = {}
+    if "mode" in options:
+        if options["mode"] not in ("dense", "hybrid"):
+            raise ValueError("retrieval mode must be 'dense' or 'hybrid'")
+        retrieval["mode"] = options["mode"]
+    if "rerank" in options:
+        if options["rerank"] not in ("none",) + RERANKERS:
+            raise ValueError(f"retrieval rerank must be one of: none, {', '.join(RERANKERS)}")
+        retrieval["rerank"] = options["rerank"]
+    if "k" in options:
+        k = options["k"]
+        if not isinstance(k, int) or isinstance(k, bool):
+            raise ValueError("retrieval k must be an integer")
+        if not 1 <= k <= MAX_RETRIEVAL_K:
+            raise ValueError(f"retrieval k must be between 1 and {MAX_RETRIEVAL_K}")
+        retrieval["k"] = k
+    for name in ("dense_weight", "sparse_weight"):
+        if name in options:
+            weight = float(options[name])
+            # NaN would make every fused score NaN, and the ranking arbitrary
+            if not math.isfinite(weight) or weight < 0:
+                raise ValueError(f"{name} must be a finite number, not negative")
+            retrieval[name] = weight
+    return retrieval
+
+def dataset_is_relevant(results):
+    # A reranker's score judges the passage itself, so it is preferred to the distance
+    # The threshold is the one for the reranker this request used
+    reranked = [doc.metadata for doc, _ in results if "rerank_score" in doc.metadata]
+    threshold = MIN_RERANK_SCORES.get(reranked[0]["reranker"]) if reranked else None
+    if threshold is not None:
+        return max(metadata["rerank_score"] for metadata in reranked) >= threshold
+    # Without a threshold every question gets a dataset answer first, as before
+    if MAX_RETRIEVAL_DISTANCE is None:
+        return True
+    # Hybrid results are in fused order, so look at the closest one rather than the first
+    return bool(results) and min(distance for _, distance in results) <= MAX_RETRIEVAL_DISTANCE
+
+# Answer cache
+def normalize_question(question):
+    question = " ".join(question.lower().split())
+    return question.strip(string.punctuation + " ")
+
+# Section/article numbers (302, 498a) and statute abbreviations, which embeddings barely tell apart
+CITATION_RE = re.compile(r"\b(?:\d+[a-z]*|ipc|crpc|cpc|bns|bnss|bsa|rti|posh|ndps|pocso|mva|ida|gst)\b")
+
+def question_citations(question):
+    return sorted(CITATION_RE.findall(question))
+
+class AnswerCache:
+    """
+    Caches finished answers keyed by the normalized question plus everything else
+    that shapes the prompt. With a similarity threshold, a question whose embedding
+    is close enough to a cached one with the same settings and the same numbers and
+    statutes (§302 and §304 questions embed almost alike) reuses its answer too.
+    Entries are evicted LRU beyond max_entries or after ttl seconds, and the whole
+    cache is dropped when the resident index version changes.
+    """
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.lookups = 0
+        self.hits = 0
+        self.semantic_hits = 0
+        self._entries = OrderedDict()  # key -> (result, unit question vector or None, created)
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(user_question, user_type, legal_area, selected_language, history_pq, retrieval=None):
+        return (normalize_question(user_question), user_type, legal_area, selected_language, history_pq or "", tuple(sorted((retrieval or {}).items())))
+
+    def _check_version(self):
+        if self._version != resident_store.version:
+            self._entries.clear()
+            self._version = resident_store.version
+
+    def _live(self, entry):
+        return time.monotonic() - entry[2] < self.ttl
+
+    def get(self, key):
+        with self._lock:
+            self._check_version()
+            self.lookups += 1
+            entry = self._entries.get(key)
+            if entry is None or not self._live(entry):
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[0])
+
+    def get_similar(self, key, query_vector):
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        citations = question_citations(key[0])
+        with self._lock:
+            self._check_version()
+            # Only questions asked with the same user type, area, language, history and
+            # retrieval options, citing the same sections and statutes, are comparable
+            candidates = [
+                (k, e) for k, e in self._entries.items()
+                if k[1:] == key[1:] and e[1] is not None and self._live(e) and question_citations(k[0]) == citations
+            ]
+            if candidates:
+                similarities = np.stack([e[1] for _, e in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    best_key = candidates[best][0]
+                    self._entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    return dict(candidates[best][1][0])
+            return None
+
+    def put(self, key, result, query_vector=None, version=None):
+        """version is resident_store.version from before retrieval; an answer built from a since-replaced index is dropped."""
+        vector = None
+        if query_vector is not None:
+            vector = np.asarray(query_vector, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            self._check_version()
+            if version is not None and version != self._version:
+                return
+            self._entries[key] = (dict(result), vector, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        hits = self.hits + self.semantic_hits
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.lookups - hits,
+            "hit_rate": hits / self.lookups if self.lookups else 0.0,
+        }
+
+answer_cache = AnswerCache()
 
 # QA Chain
-def get_conversational_chain(user_type,legal_area,selected_language,history_pq=None):
-    # print(history_pq,user_type,legal_area,selected_language)
+def get_qa_prompt():
     prompt_template = """
     You are a knowledgeable and reliable legal assistant specialized in Indian laws such as the IPC, RTI, labor laws, and other regulations. You are capable of understanding and responding to legal queries in multiple languages. If the user requests an answer in a specific language, you should provide your response in that language.
     User Type {user_type} is simple user or any Advocate Judge.
@@ -116,14 +582,8 @@ Ensure that the generated content makes proper use of HTML tags and is semantica
     Answer (in the requested language, with citations if applicable):
     """
 
-    # If HistoryPQ is not None, add it to the context
-    if history_pq:
-        context = f"Previous Question: {history_pq}\n"
-    else:
-        context = "No previous question available.\n"
-
     # Template variables to pass to the model
-    prompt = PromptTemplate(
+    return PromptTemplate(
     template=prompt_template,
     input_variables=[
         "user_type",
@@ -133,10 +593,70 @@ Ensure that the generated content makes proper use of HTML tags and is semantica
         "question"
     ]
 )
-    
-    # Use the current context and the new question for the LLM
-    model = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.3)
-    return load_qa_chain(model, chain_type="stuff", prompt=prompt)
+
+class ChainRegistry:
+    """
+    Gemini clients and QA chains shared by every request instead of built per request.
+    Models are keyed by temperature and chains by (temperature, chain type); each
+    client keeps its own connection to Gemini, so reusing it also reuses the
+    connection. Chains hold no per-request state, the question and user fields are
+    passed in when they are called.
+    """
+    def __init__(self, model_name=GEMINI_MODEL):
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._prompt = None
+        self._models = {}
+        self._chains = {}
+
+    @property
+    def prompt(self):
+        with self._lock:
+            if self._prompt is None:
+                self._prompt = get_qa_prompt()
+            return self._prompt
+
+    def model(self, temperature=ANSWER_TEMPERATURE):
+        with self._lock:
+            model = self._models.get(temperature)
+            if model is None:
+                model = self._models[temperature] = ChatGoogleGenerativeAI(model=self.model_name, temperature=temperature)
+            return model
+
+    def chain(self, temperature=ANSWER_TEMPERATURE, chain_type="stuff"):
+        key = (temperature, chain_type)
+        with self._lock:
+            chain = self._chains.get(key)
+        if chain is None:
+            chain = load_qa_chain(self.model(temperature), chain_type=chain_type, prompt=self.prompt)
+            with self._lock:
+                chain = self._chains.setdefault(key, chain)
+        return chain
+
+    def warm(self):
+        """Builds what every request uses, so the first request does not pay for it."""
+        self.chain(ANSWER_TEMPERATURE, "stuff")
+        self.model(WEB_TEMPERATURE)
+
+chains = ChainRegistry()
+
+def get_conversational_chain(user_type,legal_area,selected_language,history_pq=None):
+    # The user fields and question are inputs of the call, so one chain serves everyone
+    return chains.chain(ANSWER_TEMPERATURE, "stuff")
+
+def build_qa_prompt(user_question, user_type, legal_area, selected_language, documents):
+    # What the "stuff" chain sends: the documents joined with blank lines
+    return chains.prompt.format(
+        context="\n\n".join(doc.page_content for doc in documents),
+        question=user_question,
+        user_type=user_type,
+        legal_area=legal_area,
+        selected_language=selected_language,
+    )
+
+def pack_results(user_question, results):
+    """The best spans of the retrieved chunks, deduplicated and trimmed to the budget, with packing stats."""
+    return pack_context(user_question, results, CONTEXT_TOKEN_BUDGET or None, PASSAGE_SPANS or None)
 
 
 
@@ -184,33 +704,35 @@ Ensure that the generated content makes proper use of HTML tags and is semantica
       - Do not add ```html``` like extra things.
     """
 
-    model = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.3)
-    return model.invoke(prompt).content
+    return chains.model(ANSWER_TEMPERATURE).invoke(prompt).content
 
 
-# Question Handler
-def handle_question(user_question,user_type, legal_area, selected_language,history_pq=None):
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-    vector_store = FAISS.load_local("faiss_index", embeddings, allow_dangerous_deserialization=True)
-    docs = vector_store.similarity_search(user_question)
-    
-    # Pass the previous question (history_pq) if available
-    chain = get_conversational_chain(user_type,legal_area,selected_language,history_pq=history_pq)
-    
-    response = chain({"input_documents": docs, "question": user_question, "legal_area": legal_area, "selected_language":selected_language, "user_type": user_type}, return_only_outputs=True)
-    answer = response["output_text"]
+# Web fallback
+web_search_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="web-search")
 
-    # If the answer is short or uncertain, we look for additional web data
-    if len(answer.split()) < 30 or "i don't know" in answer.lower():
-        tavily_context = tavily_search(user_question)
-        if isinstance(tavily_context, dict) and 'content' in tavily_context:
-            web_data = tavily_context['content']
-        elif isinstance(tavily_context, str):
-            web_data = tavily_context
-        else:
-            web_data = "No useful data found."
-            
-        prompt = f"""
+def get_web_data(user_question):
+    tavily_context = tavily_search(user_question)
+    if isinstance(tavily_context, dict) and 'content' in tavily_context:
+        web_data = tavily_context['content']
+    elif isinstance(tavily_context, str):
+        web_data = tavily_context
+    else:
+        web_data = "No useful data found."
+    return web_data
+
+def start_web_search(user_question):
+    # Speculatively fetch web data while the dataset answer is generated
+    if SPECULATIVE_WEB_SEARCH:
+        return web_search_executor.submit(get_web_data, user_question)
+    return None
+
+def finish_web_search(web_future, user_question):
+    if web_future is None:
+        return get_web_data(user_question)
+    return web_future.result()
+
+def build_web_prompt(user_question, user_type, legal_area, selected_language, history_pq, web_data):
+    return f"""
         You are a legal assistant specialized in Indian laws (IPC, RTI, labor laws, and other regulations). Use the following web search results to provide a detailed, legally accurate, and easy-to-understand answer to the user's question.
         Previous Question: {history_pq}
         User Type {user_type} is simple user or any Advocate Judge
@@ -266,42 +788,153 @@ Ensure that the generated content makes proper use of HTML tags and is semantica
   - Do not add ```html``` like extra things.
         **Final Answer** (with legal references if possible):
         
-        """
+    """
+
+def lookup_answer_cache(user_question, user_type, legal_area, selected_language, history_pq, session_id, retrieval=None):
+    """
+    Returns (cache_key, query_vector, cached_result, version). cache_key is None when the
+    answer must not be cached; query_vector is set if the semantic lookup embedded the question;
+    version is the resident index version to pass to answer_cache.put with the answer.
+    """
+    # Answers that depend on a session's private uploads are never cached
+    if session_id and session_indexes.get(session_id):
+        return None, None, None, None
+    # Read before retrieval, so an index swapped while the answer is generated is noticed
+    version = resident_store.version
+    query_vector = None
+    cache_key = AnswerCache.make_key(user_question, user_type, legal_area, selected_language, history_pq, retrieval)
+    cached = answer_cache.get(cache_key)
+    if cached is None and SEMANTIC_CACHE:
+        query_vector = resident_store.embeddings.embed_query(user_question)
+        cached = answer_cache.get_similar(cache_key, query_vector)
+    return cache_key, query_vector, cached, version
+
+# Question Handler
+def handle_question(user_question,user_type, legal_area, selected_language,history_pq=None, session_id=None, retrieval=None):
+    retrieval = retrieval or {}
+    cache_key, query_vector, cached, version = lookup_answer_cache(user_question, user_type, legal_area, selected_language, history_pq, session_id, retrieval)
+    if cached is not None:
+        return {**cached, "usage": {"prompt_tokens": 0, "cached": True}}
+
+    web_future = start_web_search(user_question)
+    results = retrieve_documents_with_scores(user_question, session_id, query_vector=query_vector, **retrieval)
+    usage = {"prompt_tokens": 0}
+
+    # A poor retrieval score skips the dataset answer and goes straight to the web
+    answer = ""
+    if dataset_is_relevant(results):
+        context = pack_results(user_question, results)
+        usage.update(context.stats)
+        usage["prompt_tokens"] += estimate_tokens(build_qa_prompt(user_question, user_type, legal_area, selected_language, context.documents))
+
+        # Pass the previous question (history_pq) if available
+        chain = get_conversational_chain(user_type,legal_area,selected_language,history_pq=history_pq)
         
-        gemini_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.4)
+        response = chain({"input_documents": context.documents, "question": user_question, "legal_area": legal_area, "selected_language":selected_language, "user_type": user_type}, return_only_outputs=True)
+        answer = response["output_text"]
+
+    # If the answer is short or uncertain, we look for additional web data
+    if len(answer.split()) < 30 or "i don't know" in answer.lower():
+        web_data = finish_web_search(web_future, user_question)
+        prompt = build_web_prompt(user_question, user_type, legal_area, selected_language, history_pq, web_data)
+        usage["prompt_tokens"] += estimate_tokens(prompt)
+        gemini_model = chains.model(WEB_TEMPERATURE)
         gemini_response = gemini_model.invoke(prompt)
-        return {
+        result = {
             "source": "Internet",
             "ai_answer": gemini_response.content
         }
     else:
-        return {
+        if web_future is not None:
+            web_future.cancel()  # only stops it if it has not started yet
+        result = {
             "source": "Dataset",
             "ai_answer": answer
         }
 
+    if cache_key is not None:
+        answer_cache.put(cache_key, result, query_vector, version)
+    return {**result, "usage": usage}
+
+def stream_question(user_question, user_type, legal_area, selected_language, history_pq=None, session_id=None, retrieval=None):
+    """
+    Streaming version of handle_question. Yields (event, data) pairs: "source" as soon
+    as Dataset vs Internet is decided, "token" events with answer text as Gemini
+    produces it, then "done" with the request's estimated prompt token usage.
+    """
+    retrieval = retrieval or {}
+    cache_key, query_vector, cached, version = lookup_answer_cache(user_question, user_type, legal_area, selected_language, history_pq, session_id, retrieval)
+    if cached is not None:
+        yield "source", {"source": cached["source"]}
+        yield "token", {"text": cached["ai_answer"]}
+        yield "done", done_event(session_id, {"prompt_tokens": 0, "cached": True})
+        return
+
+    web_future = start_web_search(user_question)
+    results = retrieve_documents_with_scores(user_question, session_id, query_vector=query_vector, **retrieval)
+    source = None
+    parts = []
+    usage = {"prompt_tokens": 0}
+    if dataset_is_relevant(results):
+        context = pack_results(user_question, results)
+        usage.update(context.stats)
+        prompt = build_qa_prompt(user_question, user_type, legal_area, selected_language, context.documents)
+        usage["prompt_tokens"] += estimate_tokens(prompt)
+        model = chains.model(ANSWER_TEMPERATURE)
+
+        # Hold the dataset answer back until it is long enough to rule out the web
+        # fallback, then flush it and stream the rest as it arrives
+        for chunk in model.stream(prompt):
+            if not chunk.content:
+                continue
+            parts.append(chunk.content)
+            if source == "Dataset":
+                yield "token", {"text": chunk.content}
+                continue
+            answer = "".join(parts)
+            if "i don't know" in answer.lower():
+                break
+            if len(answer.split()) >= 30:
+                source = "Dataset"
+                if web_future is not None:
+                    web_future.cancel()
+                yield "source", {"source": source}
+                yield "token", {"text": answer}
+
+    if source is None:
+        source = "Internet"
+        yield "source", {"source": source}
+        web_data = finish_web_search(web_future, user_question)
+        prompt = build_web_prompt(user_question, user_type, legal_area, selected_language, history_pq, web_data)
+        usage["prompt_tokens"] += estimate_tokens(prompt)
+        gemini_model = chains.model(WEB_TEMPERATURE)
+        parts = []
+        for chunk in gemini_model.stream(prompt):
+            if chunk.content:
+                parts.append(chunk.content)
+                yield "token", {"text": chunk.content}
+
+    if cache_key is not None:
+        answer_cache.put(cache_key, {"source": source, "ai_answer": "".join(parts)}, query_vector, version)
+    yield "done", done_event(session_id, usage)
+
+def done_event(session_id, usage):
+    return {"session_id": session_id, "usage": usage} if session_id else {"usage": usage}
+
 def extract_multipart_data(content_type, body):
     """
-    Parses multipart/form-data manually and extracts the file content and filename.
+    Parses multipart/form-data and extracts the file content and filename.
     Returns: (filename, file_bytes)
     """
-    match = re.search(r'boundary=(.*)', content_type)
-    if not match:
+    try:
+        _, files = parse_multipart(BytesIO(body), content_type, len(body), MAX_UPLOAD_SIZE)
+    except MultipartError:
         return None, None
-
-    boundary = match.group(1).encode()
-    parts = body.split(b'--' + boundary)
-
-    for part in parts:
-        if b'Content-Disposition' in part and b'name="file"' in part:
-            headers, file_data = part.split(b'\r\n\r\n', 1)
-            file_data = file_data.rsplit(b'\r\n', 1)[0]  # Remove the trailing \r\n
-            filename_match = re.search(rb'filename="(.+?)"', headers)
-            if filename_match:
-                filename = filename_match.group(1).decode()
-                return filename, file_data
-
-    return None, None
+    upload = files.get("file")
+    if upload is None:
+        return None, None
+    with upload.file:
+        return upload.filename, upload.file.read()
 
 # Document Uploader & Analyzer
 def parse_and_analyze_file(file_bytes, content_type):
@@ -336,6 +969,22 @@ class LegalAssistantHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         
+    def _send_event_stream(self, events):
+        # Server-Sent Events, flushed one event at a time
+        self.send_response(200)
+        self._set_cors_headers()
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            for event, data in events:
+                self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client went away
+        except Exception as e:
+            self.wfile.write(f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n".encode())
+
     def do_OPTIONS(self):
         self.send_response(200)
         self._set_cors_headers()
@@ -345,70 +994,85 @@ class LegalAssistantHandler(BaseHTTPRequestHandler):
         
         content_length = int(self.headers['Content-Length'])
         content_type = self.headers['Content-Type']
-        body = self.rfile.read(content_length)
 
-        if self.path == '/query':
+        if self.path in ('/query', '/query/stream'):
             if content_type.startswith("multipart/form-data"):
-                # Extract boundary
-                match = re.search(r'boundary=(.*)$', content_type)
-                if not match:
-                    self.send_error(400, "Bad request syntax: missing boundary")
+                # Parsed straight off the socket; file parts are spooled to a temp file
+                try:
+                    form_data, files = parse_multipart(self.rfile, content_type, content_length, MAX_UPLOAD_SIZE)
+                except MultipartError as e:
+                    self.send_error(e.status, str(e))
                     return
-                boundary = match.group(1).encode()
-                parts = body.split(b'--' + boundary)
-                form_data = {}
-                filename = None
-                file_bytes = None
-
-                for part in parts:
-                    if b'Content-Disposition' in part:
-                        disposition = part.split(b'\r\n', 1)[0]
-                        name_match = re.search(rb'name="([^"]*)"', disposition)
-                        if name_match:
-                            name = name_match.group(1).decode()
-                            value_start = part.find(b'\r\n\r\n') + 4
-                            value = part[value_start:].rstrip(b'\r\n')
-                            form_data[name] = value.decode()
-
-                            if b'filename=' in disposition:
-                                filename_match = re.search(rb'filename="([^"]*)"', disposition)
-                                if filename_match:
-                                    filename = filename_match.group(1).decode()
-                                    file_bytes = value
+                upload = next(iter(files.values()), None)
+
+                # The web client sends its fields as one JSON "payload" part
+                if "payload" in form_data:
+                    try:
+                        payload = json.loads(form_data.pop("payload"))
+                        if not isinstance(payload, dict):
+                            raise ValueError("payload must be a JSON object")
+                    except ValueError as e:
+                        for part in files.values():
+                            part.file.close()
+                        self.send_error(400, f"Bad payload: {e}")
+                        return
+                    form_data.update(payload)
 
                 user_question = form_data.get("question", "")
                 history_pq = form_data.get("history_pq", None)
                 user_type = form_data.get("user_type", "user")
                 legal_area = form_data.get("legal_area", "General Law")
                 selected_language = form_data.get("selected_language", "English")
+                session_id = form_data.get("session_id") or None
+                retrieval = form_data.get("retrieval")
                 
                 # print("$", user_question,history_pq,user_type,legal_area,selected_language)
 
-                if filename and file_bytes:
-                    upload_folder = "uploads"
-                    os.makedirs(upload_folder, exist_ok=True)
-                    file_path = os.path.join(upload_folder, filename)
-                    with open(file_path, "wb") as f:
-                        f.write(file_bytes)
-
-                    # Load text and generate vector store
-                    all_text = get_all_pdf_texts(upload_folder)
-                    chunks = get_text_chunks(all_text)
-                    save_vector_store(chunks)
-                    os.remove(file_path)
+                try:
+                    if upload and upload.filename.lower().endswith(".pdf"):
+                        # Embed only this upload's chunks into the session's own overlay index
+                        session_id = session_id or uuid.uuid4().hex
+                        try:
+                            chunks = get_text_chunks(get_pdf_text(upload.file))
+                        except PdfReadError as e:
+                            self.send_error(400, f"Unreadable PDF: {e}")
+                            return
+                        try:
+                            add_to_vector_store(chunks, source=upload.filename, session_id=session_id)
+                        except Exception as e:
+                            self.send_error(500, f"Could not index the upload: {e}")
+                            return
+                finally:
+                    for part in files.values():
+                        part.file.close()
 
 
             else:  # Only JSON input
+                body = self.rfile.read(content_length)
                 json_data = json.loads(body.decode())
                 user_question = json_data.get("question", "")
                 history_pq = json_data.get("history_pq", None)
                 user_type = json_data.get("user_type", "user")
                 legal_area = json_data.get("legal_area", "General Law")
                 selected_language = json_data.get("selected_language", "English")
+                session_id = json_data.get("session_id") or None
+                retrieval = json_data.get("retrieval")
                 # print(user_question,history_pq,user_type,legal_area,selected_language)
 
             try:
-                result = handle_question(user_question, user_type, legal_area, selected_language, history_pq)
+                retrieval = parse_retrieval_options(retrieval)
+            except (ValueError, TypeError) as e:
+                self.send_error(400, f"Bad retrieval options: {e}")
+                return
+
+            if self.path == '/query/stream':
+                self._send_event_stream(stream_question(user_question, user_type, legal_area, selected_language, history_pq, session_id=session_id, retrieval=retrieval))
+                return
+
+            try:
+                result = handle_question(user_question, user_type, legal_area, selected_language, history_pq, session_id=session_id, retrieval=retrieval)
+                if session_id:
+                    result["session_id"] = session_id
                 response = json.dumps(result).encode()
                 print("\n\n",response)
                 self.send_response(200)
@@ -423,9 +1087,81 @@ class LegalAssistantHandler(BaseHTTPRequestHandler):
             self.send_error(404, "Endpoint Not Found")
 
 
+class BoundedThreadPoolHTTPServer(HTTPServer):
+    """
+    Serves requests on a fixed pool of worker threads. At most max_workers requests
+    run at once and max_queue more may wait; anything beyond that gets a 503 with
+    Retry-After instead of piling up behind slow Gemini calls. The 503s are sent
+    from a small pool of their own, never from the thread that accepts connections.
+    """
+    def __init__(self, server_address, handler_class, max_workers=MAX_WORKERS, max_queue=MAX_QUEUE, retry_after=RETRY_AFTER):
+        self.request_queue_size = max(self.request_queue_size, max_workers + max_queue)
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="legal-ai")
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.rejecter = ThreadPoolExecutor(max_workers=REJECT_WORKERS, thread_name_prefix="legal-ai-reject")
+        self.reject_slots = threading.BoundedSemaphore(MAX_REJECTS)
+        self.retry_after = retry_after
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            if self.reject_slots.acquire(blocking=False):
+                self.rejecter.submit(self.reject_request, request)
+            else:
+                self.shutdown_request(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def reject_request(self, request):
+        body = json.dumps({"error": "Server is busy, please retry"}).encode()
+        headers = (
+            "HTTP/1.1 503 Service Unavailable\r\n"
+            f"Retry-After: {self.retry_after}\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        try:
+            request.settimeout(REJECT_LINGER)
+            request.sendall(headers.encode() + body)
+            # Drain the request body until the client closes, goes quiet for 0.25 s or
+            # REJECT_LINGER runs out: closing with unread data resets the connection
+            # before the 503 is read
+            request.shutdown(socket.SHUT_WR)
+            deadline = time.monotonic() + REJECT_LINGER
+            while time.monotonic() < deadline:
+                request.settimeout(min(max(deadline - time.monotonic(), 0.01), 0.25))
+                if not request.recv(65536):
+                    break
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+            self.reject_slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        self.rejecter.shutdown(wait=True)
+
+
 # Boot microservice
-def run(server_class=HTTPServer, handler_class=LegalAssistantHandler, port=8080):
+def run(server_class=BoundedThreadPoolHTTPServer, handler_class=LegalAssistantHandler, port=8080):
     load_or_create_vector_store_from_folder("data")  # Only needs to run once
+    resident_store.load()  # Shared by every handler until the index is rebuilt
+    chains.warm()  # Gemini clients and the QA chain, reused by every request
+    if RERANKER == "cross-encoder":
+        get_reranker(RERANKER).load()  # fail at startup, not on the first question
     server_address = ('', port)
     httpd = server_class(server_address, handler_class)
     print(f"Running Legal AI Microservice on port {port}")
@@ -0,0 +1,130 @@
+import re
+import tempfile
+from collections import namedtuple
+
+READ_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+UploadedFile = namedtuple("UploadedFile", ["filename", "content_type", "file"])
+
+
+class MultipartError(ValueError):
+    """The request body is not valid multipart/form-data."""
+    status = 400
+
+
+class UploadTooLarge(MultipartError):
+    status = 413
+
+
+def get_boundary(content_type):
+    match = re.search(r'boundary="?([^";]+)"?', content_type or "")
+    if not match:
+        raise MultipartError("Bad request syntax: missing boundary")
+    return match.group(1).encode()
+
+
+def parse_multipart(stream, content_type, content_length, max_upload_size, max_field_size=64 * 1024, spool_size=1024 * 1024):
+    """
+    Parses a multipart/form-data body incrementally from stream.
+
+    Memory stays bounded by READ_SIZE plus the boundary: plain fields are copied out
+    of the read buffer through memoryview slices (and may not exceed max_field_size),
+    and file parts are written straight to a SpooledTemporaryFile that moves to disk
+    past spool_size. Returns (fields, files): field name -> str, and
+    field name -> UploadedFile with the file rewound to the start.
+    """
+    if content_length > max_upload_size:
+        raise UploadTooLarge(f"Upload exceeds {max_upload_size} bytes")
+
+    boundary = get_boundary(content_type)
+    delimiter = b"\r\n--" + boundary
+    fields, files = {}, {}
+    # Start with a CRLF so the first boundary looks like every other delimiter
+    buffer = bytearray(b"\r\n")
+    remaining = content_length
+    state = "preamble"
+    sink = name = filename = part_type = None
+
+    def fill():
+        nonlocal remaining
+        if remaining <= 0:
+            return False
+        data = stream.read(min(READ_SIZE, remaining))
+        if not data:
+            raise MultipartError("Request body ended early")
+        remaining -= len(data)
+        buffer.extend(data)
+        return True
+
+    def write(end):
+        with memoryview(buffer) as view:
+            if isinstance(sink, bytearray):
+                sink.extend(view[:end])
+                if len(sink) > max_field_size:
+                    raise MultipartError(f"Field {name!r} is too large")
+            else:
+                sink.write(view[:end])
+        del buffer[:end]
+
+    while True:
+        if state == "preamble":
+            index = buffer.find(delimiter)
+            if index < 0:
+                del buffer[:max(0, len(buffer) - len(delimiter))]
+                if not fill():
+                    raise MultipartError("Missing multipart boundary")
+                continue
+            del buffer[:index + len(delimiter)]
+            state = "after_delimiter"
+
+        elif state == "after_delimiter":
+            if len(buffer) < 2 and fill():
+                continue
+            if buffer[:2] == b"--":
+                break
+            if buffer[:2] != b"\r\n":
+                raise MultipartError("Malformed multipart boundary")
+            del buffer[:2]
+            state = "headers"
+
+        elif state == "headers":
+            index = buffer.find(b"\r\n\r\n")
+            if index < 0:
+                if len(buffer) > MAX_HEADER_SIZE:
+                    raise MultipartError("Part headers too large")
+                if not fill():
+                    raise MultipartError("Request body ended inside part headers")
+                continue
+            headers = bytes(buffer[:index]).decode("utf-8", errors="replace")
+            del buffer[:index + 4]
+            name_match = re.search(r'\bname="([^"]*)"', headers)
+            filename_match = re.search(r'\bfilename="([^"]*)"', headers)
+            type_match = re.search(r'(?im)^content-type:\s*(.+)$', headers)
+            name = name_match.group(1) if name_match else None
+            filename = filename_match.group(1) if filename_match else None
+            part_type = type_match.group(1).strip() if type_match else None
+            sink = tempfile.SpooledTemporaryFile(max_size=spool_size) if filename is not None else bytearray()
+            state = "body"
+
+        elif state == "body":
+            index = buffer.find(delimiter)
+            if index < 0:
+                # Keep enough of the tail to recognise a delimiter split across reads
+                safe = len(buffer) - len(delimiter) + 1
+                if safe > 0:
+                    write(safe)
+                if not fill():
+                    raise MultipartError("Request body ended inside a part")
+                continue
+            write(index)
+            del buffer[:len(delimiter)]
+            if name is not None:
+                if filename is not None:
+                    sink.seek(0)
+                    files[name] = UploadedFile(filename, part_type, sink)
+                else:
+                    fields[name] = sink.decode("utf-8", errors="replace")
+            state = "after_delimiter"
+
+    return fields, files
@@ -0,0 +1,79 @@
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from PyPDF2 import PdfReader
+
+PAGES_PER_TASK = 25  # large PDFs are split into page ranges of this size
+TASKS_PER_WORKER = 2  # tasks submitted ahead per worker; bounds how many results wait in memory
+
+PageText = namedtuple("PageText", ["source", "page", "text"])  # page is 1-based
+
+
+def _count_pages(pdf_path):
+    return len(PdfReader(pdf_path).pages)
+
+
+def _iter_pages(reader, pdf_path, start, stop):
+    source = os.path.basename(pdf_path)
+    for number in range(start, stop):
+        text = reader.pages[number].extract_text()
+        if text:
+            yield PageText(source, number + 1, text)
+
+
+def _extract_range(task):
+    pdf_path, start, stop = task
+    return list(_iter_pages(PdfReader(pdf_path), pdf_path, start, stop))
+
+
+def _ordered_map(pool, fn, items, window):
+    """Like pool.map, but takes items lazily and keeps at most window of them in flight."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def list_pdfs(folder_path):
+    return sorted(
+        os.path.join(folder_path, filename)
+        for filename in os.listdir(folder_path)
+        if filename.endswith(".pdf")
+    )
+
+
+def iter_pdf_pages(pdf_paths, max_workers=None, pages_per_task=PAGES_PER_TASK):
+    """
+    Yields a PageText for every non-empty page of the given PDFs, in file and page order.
+
+    Each file is cut into page ranges that are extracted in a process pool, so a
+    corpus with many files, or a few very large ones, uses every core. Page counts
+    are read in the pool too, and only TASKS_PER_WORKER tasks per worker are
+    submitted ahead of the caller, so memory stays flat however large the corpus.
+    """
+    pdf_paths = list(pdf_paths)
+    workers = max_workers or os.cpu_count() or 1
+    if workers == 1 or not pdf_paths or (len(pdf_paths) == 1 and _count_pages(pdf_paths[0]) <= pages_per_task):
+        for pdf_path in pdf_paths:
+            reader = PdfReader(pdf_path)
+            yield from _iter_pages(reader, pdf_path, 0, len(reader.pages))
+        return
+
+    window = TASKS_PER_WORKER * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        page_counts = _ordered_map(pool, _count_pages, pdf_paths, window)
+        tasks = (
+            (pdf_path, start, min(start + pages_per_task, page_count))
+            for pdf_path, page_count in zip(pdf_paths, page_counts)
+            for start in range(0, page_count, pages_per_task)
+        )
+        for pages in _ordered_map(pool, _extract_range, tasks, window):
+            yield from pages
+
+
+def iter_folder_pages(folder_path, max_workers=None):
+    return iter_pdf_pages(list_pdfs(folder_path), max_workers=max_workers)
@@ -0,0 +1,95 @@
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+
+from context_packing import score_spans, split_spans
+
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANKERS = ("lexical", "cross-encoder")
+
+
+class LexicalReranker:
+    """BM25 of each candidate against the question, with the candidates as the collection, in one numpy pass."""
+    name = "lexical"
+
+    def score(self, question, texts):
+        return score_spans(question, texts)
+
+
+class CrossEncoderReranker:
+    """
+    A sentence-transformers cross-encoder run on the CPU. It only reads about 512
+    tokens, so each candidate is represented by its best span (see best_spans)
+    rather than the first 2000 characters of a 15000-character chunk. All pairs
+    go through predict() in batches of batch_size. The model loads on first use;
+    sentence-transformers is an optional dependency.
+    """
+    name = "cross-encoder"
+
+    def __init__(self, model_name=CROSS_ENCODER_MODEL, batch_size=32):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+                except ImportError as e:
+                    raise RuntimeError("The cross-encoder reranker needs sentence-transformers (pip install sentence-transformers)") from e
+                self._model = CrossEncoder(self.model_name, device="cpu")
+            return self._model
+
+    def score(self, question, texts):
+        pairs = [(question, span) for span in best_spans(question, texts)]
+        return np.asarray(self.load().predict(pairs, batch_size=self.batch_size), dtype=np.float32)
+
+
+def best_spans(question, texts):
+    """The best-scoring span of every text, from one score_spans call over all their spans."""
+    spans, starts = [], []
+    for text in texts:
+        starts.append(len(spans))
+        spans += split_spans(text) or [text]
+    scores = score_spans(question, spans)
+    ends = starts[1:] + [len(spans)]
+    return [spans[start + int(np.argmax(scores[start:end]))] for start, end in zip(starts, ends)]
+
+
+def rerank(reranker, question, results, k):
+    """
+    Re-scores (document, distance) pairs and returns the k best, highest score first;
+    ties keep their retrieval order. The documents are copies with the score in
+    metadata["rerank_score"] and the reranker's name in metadata["reranker"], so
+    the shared docstore entries are never modified.
+    """
+    if not results:
+        return []
+    scores = reranker.score(question, [doc.page_content for doc, _ in results])
+    order = np.argsort(-scores, kind="stable")[:k]
+    return [
+        (Document(page_content=results[i][0].page_content, metadata={**results[i][0].metadata, "rerank_score": float(scores[i]), "reranker": reranker.name}), results[i][1])
+        for i in order
+    ]
+
+
+_rerankers = {}
+_rerankers_lock = threading.Lock()
+
+
+def get_reranker(name):
+    """One reranker of each kind per process, so the cross-encoder is loaded once."""
+    with _rerankers_lock:
+        reranker = _rerankers.get(name)
+        if reranker is None:
+            if name == "lexical":
+                reranker = LexicalReranker()
+            elif name == "cross-encoder":
+                reranker = CrossEncoderReranker()
+            else:
+                raise ValueError(f"Unknown reranker: {name}")
+            _rerankers[name] = reranker
+        return reranker